@@ -1,8 +1,19 @@
+import gzip
 import hashlib
+import itertools
+import json
+import re
 import sqlite3
+import numpy as np
 import pandas as pd
 import streamlit as st
 import io
+import os
+import threading
+import time
+import contextlib
+import collections
+import tempfile
 import datetime
 
 # --- CONFIGURACIÓN DE PÁGINA ---
@@ -51,17 +62,596 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# --- INSTRUMENTACIÓN (diagnóstico de rendimiento) ---
+# Se activa al arrancar con AUDITPRO_DIAGNOSTICO=1; apagada, conexiones y módulos quedan sin envolver
+INSTRUMENTACION = os.environ.get("AUDITPRO_DIAGNOSTICO", "0") == "1"
+UMBRAL_CONSULTA_LENTA_MS = float(os.environ.get("AUDITPRO_UMBRAL_LENTA_MS", "100"))
+MUESTRAS_DIAGNOSTICO = 1000
+
+class Metricas:
+    """Acumula tiempos de sentencias SQL, módulos y reejecuciones; compartida por todas las sesiones."""
+
+    def __init__(self, umbral_ms=UMBRAL_CONSULTA_LENTA_MS):
+        self.umbral_ms = umbral_ms
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self._lock:
+            self.consultas = {}  # sql -> [ejecuciones, ms_total, ms_max, filas]
+            self.lentas = collections.deque(maxlen=200)
+            self.modulos = collections.defaultdict(lambda: collections.deque(maxlen=MUESTRAS_DIAGNOSTICO))  # (ms, ms_sql)
+            self.reruns = collections.deque(maxlen=MUESTRAS_DIAGNOSTICO)
+
+    def _activos(self):
+        # Pila de módulos en ejecución en este hilo, para atribuirles el tiempo de SQL
+        if not hasattr(self._local, 'pila'): self._local.pila = []
+        return self._local.pila
+
+    def registrar_consulta(self, sql, ms, filas):
+        # Nunca se guardan los parámetros: incluyen correos y hashes de contraseña (autenticar)
+        sql = " ".join(sql.split())
+        for marco in self._activos(): marco[1] += ms
+        with self._lock:
+            c = self.consultas.setdefault(sql, [0, 0.0, 0.0, 0])
+            c[0] += 1; c[1] += ms; c[2] = max(c[2], ms); c[3] += filas
+            if ms >= self.umbral_ms:
+                self.lentas.append((datetime.datetime.now().isoformat(timespec='seconds'), round(ms, 2), filas, sql))
+
+    @contextlib.contextmanager
+    def medir_modulo(self, nombre):
+        marco = [nombre, 0.0]
+        pila = self._activos(); pila.append(marco)
+        inicio = time.perf_counter()
+        try: yield
+        finally:
+            pila.remove(marco)
+            with self._lock: self.modulos[nombre].append(((time.perf_counter() - inicio) * 1000, marco[1]))
+
+    def registrar_rerun(self, ms):
+        with self._lock: self.reruns.append(ms)
+
+    def top_consultas(self, n=20):
+        with self._lock: filas = [(sql, *c) for sql, c in self.consultas.items()]
+        df = pd.DataFrame(filas, columns=["SQL", "Ejecuciones", "ms total", "ms máx", "Filas"])
+        df["ms promedio"] = df["ms total"] / df["Ejecuciones"]
+        df = df.sort_values("ms total", ascending=False)
+        return df if n is None else df.head(n)
+
+    def resumen_modulos(self):
+        with self._lock: muestras = {nombre: np.array(list(m)) for nombre, m in self.modulos.items() if m}
+        return pd.DataFrame([(nombre, len(m), *np.percentile(m[:, 0], [50, 95]), np.percentile(m[:, 1], 50), np.percentile(m[:, 0] - m[:, 1], 50))
+                             for nombre, m in muestras.items()],
+                            columns=["Módulo", "Ejecuciones", "p50 ms", "p95 ms", "p50 SQL ms", "p50 resto ms"])
+
+    def latencia_reruns(self):
+        with self._lock: muestras = list(self.reruns)
+        if not muestras: return None
+        p50, p95 = np.percentile(muestras, [50, 95])
+        return {'n': len(muestras), 'p50_ms': float(p50), 'p95_ms': float(p95)}
+
+    def exportar(self):
+        return {'fecha': datetime.datetime.now().isoformat(timespec='seconds'), 'umbral_lenta_ms': self.umbral_ms,
+                'reruns': self.latencia_reruns(), 'modulos': self.resumen_modulos().to_dict(orient='records'),
+                'consultas': self.top_consultas(n=None).to_dict(orient='records'), 'lentas': list(self.lentas)}
+
+@st.cache_resource
+def obtener_metricas():
+    return Metricas()
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """Mide cada sentencia: su ejecución más la lectura de sus filas, hasta agotarla o cerrar el cursor."""
+    _sql, _ms, _filas = None, 0.0, 0
+
+    def _cerrar_medicion(self):
+        if self._sql is not None:
+            filas = self._filas if self.description else max(self.rowcount, 0)
+            obtener_metricas().registrar_consulta(self._sql, self._ms, filas)
+            self._sql = None
+
+    def _medir(self, fn, *args):
+        inicio = time.perf_counter()
+        try: return fn(*args)
+        finally: self._ms += (time.perf_counter() - inicio) * 1000
+
+    def execute(self, sql, params=()):
+        self._cerrar_medicion()
+        self._sql, self._ms, self._filas = sql, 0.0, 0
+        self._medir(super().execute, sql, params)
+        if not self.description: self._cerrar_medicion()
+        return self
+
+    def executemany(self, sql, filas):
+        self._cerrar_medicion()
+        self._sql, self._ms, self._filas = sql, 0.0, 0
+        self._medir(super().executemany, sql, filas)
+        self._cerrar_medicion()
+        return self
+
+    def fetchone(self):
+        fila = self._medir(super().fetchone)
+        if fila is None: self._cerrar_medicion()
+        else: self._filas += 1
+        return fila
+
+    def fetchmany(self, size=None):
+        filas = self._medir(super().fetchmany, size or self.arraysize)
+        self._filas += len(filas)
+        if not filas: self._cerrar_medicion()
+        return filas
+
+    def fetchall(self):
+        filas = self._medir(super().fetchall)
+        self._filas += len(filas); self._cerrar_medicion()
+        return filas
+
+    def __next__(self):
+        try: fila = self._medir(super().__next__)
+        except StopIteration:
+            self._cerrar_medicion(); raise
+        self._filas += 1
+        return fila
+
+    def close(self):
+        self._cerrar_medicion(); super().close()
+
+    def __del__(self):
+        try: self._cerrar_medicion()
+        except Exception: pass
+
+class ConexionInstrumentada(sqlite3.Connection):
+    # Connection.execute no pasa por cursor(); se redirige para que todo quede medido
+    def cursor(self, factory=None):
+        return super().cursor(factory or CursorInstrumentado)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, filas):
+        return self.cursor().executemany(sql, filas)
+
+def instrumentar(fn):
+    """Decorador: mide cada llamada del módulo por reejecución. Sin diagnóstico devuelve la función intacta."""
+    if not INSTRUMENTACION: return fn
+    def envoltura(*args, **kwargs):
+        with obtener_metricas().medir_modulo(fn.__name__):
+            return fn(*args, **kwargs)
+    envoltura.__name__, envoltura.__doc__ = fn.__name__, fn.__doc__
+    return envoltura
+
+@contextlib.contextmanager
+def medir_rerun():
+    if not INSTRUMENTACION:
+        yield; return
+    inicio = time.perf_counter()
+    try: yield
+    finally: obtener_metricas().registrar_rerun((time.perf_counter() - inicio) * 1000)
+
 # --- BASE DE DATOS ---
-def get_db_connection():
-    return sqlite3.connect('audit_management.db', timeout=10, check_same_thread=False)
+EVIDENCE_DIR = 'evidencias'
+
+DB_PATH = 'audit_management.db'
+# Modo shards (AUDITPRO_SHARDS=1): users y clients en un catálogo y cada cliente en su propio archivo,
+# así la escritura de un encargo no bloquea a los demás (SQLite admite un solo escritor por base)
+MODO_SHARDS = os.environ.get("AUDITPRO_SHARDS", "0") == "1"
+CATALOGO_PATH = 'audit_catalog.db'
+SHARDS_DIR = 'shards'
+MAX_BASES_POR_HILO = 32
+# Cada shard numera sus ids desde client_id * BLOQUE_IDS para que sigan siendo únicos entre clientes
+BLOQUE_IDS = 10**9
+
+def ruta_base(client_id=None, shards=MODO_SHARDS):
+    if not shards: return DB_PATH
+    return CATALOGO_PATH if client_id is None else os.path.join(SHARDS_DIR, f"cliente_{int(client_id)}.db")
+
+def get_db_connection(ruta=DB_PATH):
+    # Modo autocommit: las transacciones se abren explícitamente con transaccion()
+    conn = sqlite3.connect(ruta, timeout=10, check_same_thread=False, isolation_level=None,
+                           factory=ConexionInstrumentada if INSTRUMENTACION else sqlite3.Connection)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+class PoolConexiones:
+    """Una conexión SQLite por hilo y por archivo de base, compartida por todo el proceso."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._conexiones = {}  # ident del hilo -> OrderedDict(ruta -> conexión), la más reciente al final
+        self._lock = threading.Lock()
+
+    def obtener(self, ruta=DB_PATH):
+        del_hilo = self._conexiones.get(threading.get_ident())
+        conn = del_hilo.get(ruta) if del_hilo is not None else None
+        if conn is None:
+            conn = self._factory(ruta)
+            with self._lock:
+                self._cerrar_huerfanas()
+                del_hilo = self._conexiones.setdefault(threading.get_ident(), collections.OrderedDict())
+                del_hilo[ruta] = conn
+                self._limitar(del_hilo)
+        elif len(del_hilo) > 1:
+            del_hilo.move_to_end(ruta)
+        return conn
+
+    def _limitar(self, del_hilo):
+        # En modo shards un hilo puede recorrer muchos clientes; se cierran las menos usadas.
+        # La base principal nunca: quien recorre los shards (consultar_clientes) la tiene en uso
+        for ruta in list(del_hilo)[:-1]:
+            if len(del_hilo) <= MAX_BASES_POR_HILO: break
+            if ruta != ruta_base() and not del_hilo[ruta].in_transaction: del_hilo.pop(ruta).close()
+
+    def _cerrar_huerfanas(self):
+        # Streamlit crea hilos nuevos para las reejecuciones; se liberan las de hilos terminados
+        vivos = {t.ident for t in threading.enumerate()}
+        for ident in [i for i in self._conexiones if i not in vivos]:
+            for conn in self._conexiones.pop(ident).values(): conn.close()
+
+    def cerrar(self):
+        with self._lock:
+            for del_hilo in self._conexiones.values():
+                for conn in del_hilo.values(): conn.close()
+            self._conexiones.clear()
+
+@st.cache_resource
+def obtener_pool():
+    return PoolConexiones(get_db_connection)
+
+@st.cache_resource
+def obtener_estado_shards():
+    # Shards ya migrados en este proceso
+    return {'listos': set(), 'en_curso': set(), 'lock': threading.RLock()}
+
+def preparar_shard(client_id):
+    """Crea o migra el archivo del cliente la primera vez que el proceso lo abre."""
+    estado = obtener_estado_shards()
+    if client_id in estado['listos']: return
+    with estado['lock']:
+        if client_id in estado['listos'] or client_id in estado['en_curso']: return
+        estado['en_curso'].add(client_id)
+        try:
+            os.makedirs(SHARDS_DIR, exist_ok=True)
+            # Conexión propia y efímera: migrar no debe desplazar del pool las que el hilo tiene en uso
+            conn = get_db_connection(ruta_base(client_id))
+            try:
+                if migrar_base(conn, AMBITO_CLIENTE): sembrar_secuencias(conn, client_id)
+            finally: conn.close()
+        finally:
+            estado['en_curso'].discard(client_id)
+        estado['listos'].add(client_id)
+
+def _conexion_base(client_id):
+    # Sin client_id (o en modo monolítico) se usa la base principal: catálogo o audit_management.db
+    if MODO_SHARDS and client_id is not None:
+        client_id = int(client_id); preparar_shard(client_id)
+    return obtener_pool().obtener(ruta_base(client_id))
+
+@contextlib.contextmanager
+def conexion(client_id=None):
+    # Lecturas: con WAL nunca bloquean a los escritores
+    yield _conexion_base(client_id)
+
+@contextlib.contextmanager
+def transaccion(client_id=None):
+    """Escritura corta: BEGIN IMMEDIATE, commit al salir y rollback ante cualquier error."""
+    conn = _conexion_base(client_id)
+    if conn.in_transaction:
+        yield conn; return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback(); raise
+    else:
+        conn.commit()
+
+def clientes_con_base(incluir_eliminados=False):
+    """Ids de cliente según el catálogo; en modo shards, solo los que ya tienen archivo."""
+    with conexion() as conn:
+        ids = [c for (c,) in conn.execute("SELECT id FROM clients" + ("" if incluir_eliminados else " WHERE is_deleted=0") + " ORDER BY id")]
+    return [c for c in ids if os.path.exists(ruta_base(c))] if MODO_SHARDS else ids
+
+def bases_de_clientes():
+    # Tareas de mantenimiento: una pasada por archivo (None = la base monolítica)
+    return clientes_con_base(incluir_eliminados=True) if MODO_SHARDS else [None]
+
+def consultar_clientes(plantilla, params=(), client_ids=None, incluir_eliminados=False):
+    """Ejecuta una consulta sobre las tablas de varios clientes y devuelve todas las filas.
+
+    `plantilla` antepone {base} a las tablas de cliente y puede unir tablas del
+    catálogo (clients, users). En modo shards se adjuntan (ATTACH) los archivos
+    de los clientes en tandas del máximo que admite SQLite y cada tanda se
+    resuelve en una sola sentencia UNION ALL; el orden final queda a cargo de quien llama.
+    """
+    with conexion() as conn:
+        if not MODO_SHARDS: return conn.execute(plantilla.format(base="main"), params).fetchall()
+        ids = clientes_con_base(incluir_eliminados) if client_ids is None else [c for c in client_ids if os.path.exists(ruta_base(c))]
+        tanda = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        filas = []
+        for inicio in range(0, len(ids), tanda):
+            alias = []
+            try:
+                for cid in ids[inicio:inicio + tanda]:
+                    preparar_shard(cid)
+                    conn.execute(f"ATTACH DATABASE ? AS c{len(alias)}", (ruta_base(cid),)); alias.append(f"c{len(alias)}")
+                sql = " UNION ALL ".join(f"SELECT * FROM ({plantilla.format(base=a)})" for a in alias)
+                filas.extend(conn.execute(sql, tuple(params) * len(alias)).fetchall())
+            finally:
+                for a in alias: conn.execute(f"DETACH DATABASE {a}")
+        return filas
+
+# --- CACHÉ DE LECTURAS (invalidación por versión) ---
+CACHE_CLIENTES = 0  # versión de la lista de clientes
 
-def create_tables():
-    conn = get_db_connection()
+class CacheDatos:
+    """LRU acotada en memoria del proceso.
+
+    Cada clave incluye la versión de datos del cliente; al escribir se incrementa
+    la versión y las entradas anteriores dejan de ser alcanzables hasta que la LRU
+    las expulsa.
+    """
+
+    def __init__(self, max_entradas=512):
+        self.max_entradas = max_entradas
+        self.aciertos = 0
+        self.fallos = 0
+        self._entradas = collections.OrderedDict()
+        self._versiones = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def invalidar(self, client_id):
+        with self._lock: self._versiones[client_id] += 1
+
+    def obtener(self, client_id, nombre, args, cargar):
+        clave = (client_id, self._versiones[client_id], nombre, args)
+        with self._lock:
+            if clave in self._entradas:
+                self._entradas.move_to_end(clave); self.aciertos += 1
+                return self._entradas[clave]
+            self.fallos += 1
+        valor = cargar()
+        with self._lock:
+            self._entradas[clave] = valor
+            while len(self._entradas) > self.max_entradas: self._entradas.popitem(last=False)
+        return valor
+
+    def estadisticas(self):
+        total = self.aciertos + self.fallos
+        return {'aciertos': self.aciertos, 'fallos': self.fallos, 'entradas': len(self._entradas),
+                'tasa_aciertos': self.aciertos / total if total else 0.0}
+
+@st.cache_resource
+def obtener_cache():
+    return CacheDatos()
+
+def invalidar_cliente(*client_ids):
+    cache = obtener_cache()
+    for client_id in client_ids: cache.invalidar(client_id)
+
+# --- ALMACÉN DE EVIDENCIAS (direccionado por contenido) ---
+def ruta_evidencia(file_hash):
+    return os.path.join(EVIDENCE_DIR, file_hash[:2], file_hash)
+
+def almacenar_archivo(origen, tam_bloque=1024 * 1024):
+    """Copia un archivo al almacén por bloques y devuelve (sha256, tamaño).
+
+    El nombre en disco es el hash del contenido, así que dos cargas idénticas
+    comparten un único archivo.
+    """
+    tmp, file_hash, tam = copiar_temporal(origen, tam_bloque)
+    publicar_archivo(tmp, file_hash)
+    return file_hash, tam
+
+def copiar_temporal(origen, tam_bloque=1024 * 1024):
+    # Copia y hash en una sola pasada; el temporal aún no es visible en el almacén
+    os.makedirs(EVIDENCE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=EVIDENCE_DIR, suffix='.tmp')
+    h = hashlib.sha256(); tam = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                bloque = origen.read(tam_bloque)
+                if not bloque: break
+                h.update(bloque); out.write(bloque); tam += len(bloque)
+    except Exception:
+        os.remove(tmp); raise
+    return tmp, h.hexdigest(), tam
+
+def publicar_archivo(tmp, file_hash):
+    destino = ruta_evidencia(file_hash)
+    if os.path.exists(destino): os.remove(tmp)
+    else:
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(tmp, destino)
+
+@st.cache_resource
+def obtener_lock_almacen():
+    # Publicar un archivo + insertar su fila, y verificar referencias + borrar, nunca se intercalan
+    return threading.Lock()
+
+def leer_evidencia(file_hash):
+    # Solo se invoca cuando el usuario pulsa "Descargar"
+    with open(ruta_evidencia(file_hash), 'rb') as f:
+        return f.read()
+
+def migrar_evidencias_blob(conn):
+    # Migración única: mueve los BLOB antiguos al almacén en disco, fila por fila
+    ids = [r[0] for r in conn.execute("SELECT id FROM audit_evidence WHERE file_data IS NOT NULL").fetchall()]
+    for ev_id in ids:
+        blob = conn.execute("SELECT file_data FROM audit_evidence WHERE id=?", (ev_id,)).fetchone()[0]
+        file_hash, tam = almacenar_archivo(io.BytesIO(blob))
+        conn.execute("UPDATE audit_evidence SET file_hash=?, file_size=?, file_data=NULL WHERE id=?", (file_hash, tam, ev_id))
+
+# --- ARCHIVO SEGMENTADO DE LA BITÁCORA (audit_logs) ---
+LOG_ARCHIVE_DIR = 'archivo_logs'
+HASH_GENESIS = "0" * 64
+COLUMNAS_LOG = ("id", "step_id", "user_id", "user_name", "action", "previous_value", "new_value", "timestamp")
+FILAS_POR_SEGMENTO = 20_000  # cada segmento es una transacción corta; los auditores no esperan al archivado completo
+
+def directorio_archivo(client_id=None):
+    # En modo shards cada cliente lleva su propia cadena de segmentos
+    return os.path.join(LOG_ARCHIVE_DIR, f"cliente_{int(client_id)}") if MODO_SHARDS and client_id is not None else LOG_ARCHIVE_DIR
+
+def _encadenar(hash_previo, bloque):
+    return hashlib.sha256((hash_previo + hashlib.sha256(bloque).hexdigest()).encode()).hexdigest()
+
+def archivar_logs(antes_de=None, incluir_eliminados=True, client_ids=()):
+    """Mueve registros de audit_logs a segmentos comprimidos de solo anexado.
+
+    Se archivan los registros anteriores a ``antes_de`` (fecha ISO), los de
+    clientes eliminados y los de ``client_ids`` (encargos cerrados), en tandas de
+    ~FILAS_POR_SEGMENTO filas con una transacción cada una. Cada segmento
+    es una concatenación de miembros gzip, uno por paso, con un índice
+    (paso -> desplazamiento) en log_segment_index y una cadena de hashes que
+    continúa la del segmento anterior. Devuelve el número de filas archivadas.
+    En modo shards cada cliente archiva en su propia cadena.
+    """
+    if MODO_SHARDS:
+        # La base de un cliente eliminado o cerrado se archiva completa
+        with conexion() as conn:
+            completos = {c for (c,) in conn.execute("SELECT id FROM clients WHERE is_deleted=1")} if incluir_eliminados else set()
+        completos |= {int(c) for c in client_ids}
+        total = 0
+        for cid in clientes_con_base(incluir_eliminados=True):
+            if cid in completos: total += _archivar_segmento(cid, ["1"], [])
+            elif antes_de: total += _archivar_segmento(cid, ["l.timestamp < ?"], [str(antes_de)])
+        return total
+    criterios, params = [], []
+    if antes_de: criterios.append("l.timestamp < ?"); params.append(str(antes_de))
+    if incluir_eliminados: criterios.append("c.is_deleted = 1")
+    if client_ids: criterios.append("s.client_id IN (SELECT value FROM json_each(?))"); params.append(json.dumps([int(c) for c in client_ids]))
+    if not criterios: return 0
+    return _archivar_segmento(None, criterios, params, "JOIN audit_steps s ON s.id = l.step_id JOIN clients c ON c.id = s.client_id")
+
+def _archivar_segmento(client_id, criterios, params, uniones=""):
+    # Tandas de pasos consecutivos de ~FILAS_POR_SEGMENTO filas; cada una continúa la cadena de la anterior
+    total, ultimo = 0, None
+    while True:
+        filas, ultimo = _archivar_tanda(client_id, criterios, params, uniones, ultimo)
+        total += filas
+        if ultimo is None: return total
+
+def _archivar_tanda(client_id, criterios, params, uniones, desde_paso):
+    """Archiva en un segmento las filas de los pasos siguientes a ``desde_paso``; devuelve (filas, último paso o None al terminar)."""
+    directorio = directorio_archivo(client_id)
+    os.makedirs(directorio, exist_ok=True)
+    filtro, args = f"({' OR '.join(criterios)})", list(params)
+    if desde_paso is not None: filtro += " AND l.step_id > ?"; args.append(desde_paso)
+    with transaccion(client_id) as conn:
+        # Paso en el que la tanda alcanza el tope de filas; sus filas restantes entran en la misma tanda
+        tope = conn.execute(f"SELECT l.step_id FROM audit_logs l {uniones} WHERE {filtro} ORDER BY l.step_id LIMIT 1 OFFSET ?",
+                            (*args, FILAS_POR_SEGMENTO - 1)).fetchone()
+        if tope: filtro += " AND l.step_id <= ?"; args.append(tope[0])
+        previo = conn.execute("SELECT chain_hash FROM log_segments ORDER BY id DESC LIMIT 1").fetchone()
+        hash_cadena = hash_previo = previo[0] if previo else HASH_GENESIS
+        seg_id = conn.execute("INSERT INTO log_segments (file_name, prev_hash) VALUES ('', ?)", (hash_previo,)).lastrowid
+        nombre = f"segmento_{seg_id:06d}.jsonl.gz"
+        ruta = os.path.join(directorio, nombre)
+        cur = conn.execute(f"""SELECT l.{', l.'.join(COLUMNAS_LOG)} FROM audit_logs l {uniones}
+            WHERE {filtro} ORDER BY l.step_id, l.timestamp, l.id""", args)
+        indice, ids, offset = [], [], 0
+        with open(ruta + ".tmp", "wb") as f:
+            for step_id, filas in itertools.groupby(cur, key=lambda r: r[1]):
+                filas = list(filas)
+                bloque = gzip.compress("".join(json.dumps(dict(zip(COLUMNAS_LOG, r)), ensure_ascii=False) + "\n" for r in filas).encode())
+                f.write(bloque)
+                hash_cadena = _encadenar(hash_cadena, bloque)
+                indice.append((step_id, seg_id, offset, len(bloque), len(filas), hash_cadena))
+                ids.extend(r[0] for r in filas); offset += len(bloque)
+            f.flush(); os.fsync(f.fileno())
+        if not ids:
+            os.remove(ruta + ".tmp"); conn.rollback(); return 0, None
+        os.replace(ruta + ".tmp", ruta); os.chmod(ruta, 0o444)
+        conn.executemany("INSERT INTO log_segment_index (step_id, segment_id, offset, length, rows, block_hash) VALUES (?,?,?,?,?,?)", indice)
+        conn.execute("UPDATE log_segments SET file_name=?, rows=?, first_log_id=?, last_log_id=?, chain_hash=? WHERE id=?",
+                     (nombre, len(ids), min(ids), max(ids), hash_cadena, seg_id))
+        conn.execute("DELETE FROM audit_logs WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))
+        clientes = [c for (c,) in conn.execute("SELECT DISTINCT client_id FROM audit_steps WHERE id IN (SELECT value FROM json_each(?))",
+                                                (json.dumps([i[0] for i in indice]),))]
+    invalidar_cliente(*clientes)
+    return len(ids), tope[0] if tope else None
+
+def leer_archivo_paso(conn, step_id, directorio=LOG_ARCHIVE_DIR):
+    # Lee solo los bloques del paso (desplazamiento y longitud del índice)
+    filas = []
+    for nombre, offset, length in conn.execute("""SELECT g.file_name, i.offset, i.length FROM log_segment_index i
+            JOIN log_segments g ON g.id = i.segment_id WHERE i.step_id=? ORDER BY i.segment_id""", (step_id,)):
+        with open(os.path.join(directorio, nombre), "rb") as f:
+            f.seek(offset)
+            filas.extend(json.loads(l) for l in gzip.decompress(f.read(length)).decode().splitlines())
+    return filas
+
+def leer_historial(step_id, limite=None, client_id=None):
+    """Historial de un paso (más reciente primero) uniendo audit_logs y los segmentos archivados."""
+    with conexion(client_id) as conn:
+        calientes = conn.execute("SELECT timestamp, user_name, action FROM audit_logs WHERE step_id=? ORDER BY timestamp DESC, id DESC", (step_id,)).fetchall()
+        if limite and len(calientes) >= limite: return calientes[:limite]
+        archivados = leer_archivo_paso(conn, step_id, directorio_archivo(client_id))
+    # Mismo orden que audit_logs: (timestamp, id) descendente
+    archivados.sort(key=lambda r: (r['timestamp'] or "", r['id']), reverse=True)
+    historial = calientes + [(r['timestamp'], r['user_name'], r['action']) for r in archivados]
+    return historial[:limite] if limite else historial
+
+def verificar_archivo_logs(client_id=None):
+    """Recorre los segmentos bloque a bloque y valida la cadena de hashes.
+
+    Devuelve [(segment_id, ok, detalle)]. Nunca carga un segmento completo en memoria.
+    """
+    resultado, hash_esperado = [], HASH_GENESIS
+    with conexion(client_id) as conn:
+        segmentos = conn.execute("SELECT id, file_name, prev_hash, chain_hash FROM log_segments WHERE chain_hash IS NOT NULL ORDER BY id").fetchall()
+        for seg_id, nombre, prev_hash, chain_hash in segmentos:
+            if prev_hash != hash_esperado:
+                resultado.append((seg_id, False, "El segmento no continúa la cadena del anterior")); hash_esperado = chain_hash; continue
+            ruta, h, ok, detalle = os.path.join(directorio_archivo(client_id), nombre), prev_hash, True, "Íntegro"
+            try:
+                with open(ruta, "rb") as f:
+                    for offset, length, block_hash in conn.execute("SELECT offset, length, block_hash FROM log_segment_index WHERE segment_id=? ORDER BY offset", (seg_id,)):
+                        f.seek(offset)
+                        h = _encadenar(h, f.read(length))
+                        if h != block_hash: ok, detalle = False, f"Bloque alterado en el desplazamiento {offset}"; break
+                    if ok and f.seek(0, os.SEEK_END) != offset + length: ok, detalle = False, "El archivo tiene datos no indexados"
+                if ok and h != chain_hash: ok, detalle = False, "El hash final no coincide"
+            except OSError as e:
+                ok, detalle = False, f"No se pudo leer el segmento: {e}"
+            resultado.append((seg_id, ok, detalle))
+            hash_esperado = chain_hash
+    return resultado
+
+# --- RESUMEN DE AVANCE (client_progress) ---
+def reconstruir_resumen_progreso(conn):
+    """Recalcula client_progress desde audit_steps y devuelve cuántas filas habían derivado."""
+    antes = {(c, a): fila for c, a, *fila in conn.execute("SELECT client_id, area_name, sin_iniciar, en_proceso, terminado, evidencias FROM client_progress")}
+    conn.execute("DELETE FROM client_progress")
+    conn.execute("""INSERT INTO client_progress (client_id, area_name, sin_iniciar, en_proceso, terminado, evidencias)
+        SELECT s.client_id, s.area_name, SUM(s.status = 'Sin Iniciar'), SUM(s.status = 'En Proceso'), SUM(s.status = 'Terminado'), COALESCE(SUM(e.n), 0)
+        FROM audit_steps s LEFT JOIN (SELECT step_id, COUNT(*) AS n FROM audit_evidence GROUP BY step_id) e ON e.step_id = s.id
+        WHERE s.is_deleted = 0 GROUP BY s.client_id, s.area_name""")
+    despues = {(c, a): fila for c, a, *fila in conn.execute("SELECT client_id, area_name, sin_iniciar, en_proceso, terminado, evidencias FROM client_progress")}
+    # Las áreas que quedaron en cero no se recrean; no cuentan como deriva
+    return sum(1 for k in antes.keys() | despues.keys() if antes.get(k, [0, 0, 0, 0]) != despues.get(k, [0, 0, 0, 0]))
+
+def leer_progreso_clientes():
+    # O(clientes x áreas) sobre la tabla resumen; nunca recorre audit_steps
+    return {cid: {'sin_iniciar': si, 'en_proceso': ep, 'terminado': te, 'evidencias': ev} for cid, si, ep, te, ev in consultar_clientes(
+        "SELECT client_id, SUM(sin_iniciar), SUM(en_proceso), SUM(terminado), SUM(evidencias) FROM {base}.client_progress GROUP BY client_id")}
+
+def leer_progreso_areas(conn, client_id):
+    return pd.read_sql_query("""SELECT area_name AS Área, sin_iniciar AS "Sin Iniciar", en_proceso AS "En Proceso", terminado AS Terminado, evidencias AS Evidencias
+        FROM client_progress WHERE client_id=? AND sin_iniciar + en_proceso + terminado > 0 ORDER BY area_name""", conn, params=(client_id,))
+
+# --- MIGRACIONES DE ESQUEMA ---
+def create_tables(conn):
     cursor = conn.cursor()
-    
+
     cursor.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT UNIQUE, full_name TEXT, password_hash TEXT, role TEXT DEFAULT "Miembro")')
     cursor.execute('CREATE TABLE IF NOT EXISTS clients (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, client_name TEXT, client_nit TEXT, is_deleted INTEGER DEFAULT 0)')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS audit_steps (
         id INTEGER PRIMARY KEY AUTOINCREMENT, 
         client_id INTEGER, 
@@ -73,9 +663,9 @@ def create_tables():
         user_notes TEXT, 
         status TEXT DEFAULT "Sin Iniciar", 
         is_deleted INTEGER DEFAULT 0)''')
-    
+
     cursor.execute('CREATE TABLE IF NOT EXISTS materiality (client_id INTEGER PRIMARY KEY, benchmark TEXT, benchmark_value REAL, p_general REAL, mat_general REAL, p_performance REAL, mat_performance REAL, p_ranr REAL, mat_ranr REAL)')
-    
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS audit_logs (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         step_id INTEGER,
@@ -98,32 +688,257 @@ def create_tables():
         upload_date DATETIME DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY(step_id) REFERENCES audit_steps(id)
     )''')
-    
-    try: cursor.execute("ALTER TABLE audit_steps ADD COLUMN area_name TEXT DEFAULT 'General'")
-    except: pass
-        
+
+    agregar_columna(conn, 'audit_steps', 'area_name', "TEXT DEFAULT 'General'")
+
+def agregar_columna(conn, tabla, columna, definicion):
+    # Solo se omite si la columna ya existe; cualquier otro error revierte la migración
+    if columna not in {r[1] for r in conn.execute(f"PRAGMA table_info({tabla})")}:
+        conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+def migracion_evidencias_en_disco(conn):
+    # Evidencias: la tabla solo guarda metadatos y el hash del archivo en disco
+    agregar_columna(conn, 'audit_evidence', 'file_hash', "TEXT")
+    agregar_columna(conn, 'audit_evidence', 'file_size', "INTEGER")
+    migrar_evidencias_blob(conn)
+
+def migracion_indices(conn):
+    # Índices compuestos alineados con las rutas de acceso del programa de trabajo
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_steps_cliente ON audit_steps (client_id, is_deleted, section_name, area_name, step_code)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_evidence_step ON audit_evidence (step_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_evidence_hash ON audit_evidence (file_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_step ON audit_logs (step_id, timestamp)")
+
+def migracion_indice_codigos(conn):
+    # Detección de duplicados en la importación masiva
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_steps_codigo ON audit_steps (client_id, step_code)")
+
+def migracion_busqueda_texto(conn):
+    # Índice FTS5 sobre los pasos activos; los triggers lo mantienen sincronizado
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS audit_steps_fts USING fts5(
+        step_code, description, instructions, user_notes,
+        content='audit_steps', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+    columnas = "step_code, description, instructions, user_notes"
+    nuevos = "new.id, new.step_code, new.description, new.instructions, new.user_notes"
+    viejos = "'delete', old.id, old.step_code, old.description, old.instructions, old.user_notes"
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_steps_fts_ins AFTER INSERT ON audit_steps WHEN new.is_deleted = 0 BEGIN
+        INSERT INTO audit_steps_fts (rowid, {columnas}) VALUES ({nuevos}); END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_steps_fts_del AFTER DELETE ON audit_steps WHEN old.is_deleted = 0 BEGIN
+        INSERT INTO audit_steps_fts (audit_steps_fts, rowid, {columnas}) VALUES ({viejos}); END""")
+    # Una actualización retira la versión anterior y luego agrega la nueva (en ese orden);
+    # el borrado lógico solo retira
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_steps_fts_upd AFTER UPDATE OF {columnas}, is_deleted ON audit_steps BEGIN
+        INSERT INTO audit_steps_fts (audit_steps_fts, rowid, {columnas}) SELECT {viejos} WHERE old.is_deleted = 0;
+        INSERT INTO audit_steps_fts (rowid, {columnas}) SELECT {nuevos} WHERE new.is_deleted = 0; END""")
+    conn.execute(f"INSERT INTO audit_steps_fts (rowid, {columnas}) SELECT id, {columnas} FROM audit_steps WHERE is_deleted = 0")
+
+def migracion_claves_paginacion(conn):
+    # La paginación por clave compara (sección, área, código): no deben quedar NULL
+    conn.execute("""UPDATE audit_steps SET section_name = COALESCE(section_name, 'General'),
+        area_name = COALESCE(area_name, 'General'), step_code = COALESCE(step_code, '')
+        WHERE section_name IS NULL OR area_name IS NULL OR step_code IS NULL""")
+
+def migracion_version_pasos(conn):
+    # Control de concurrencia optimista: cada guardado incrementa la versión del paso
+    agregar_columna(conn, 'audit_steps', 'version', "INTEGER NOT NULL DEFAULT 0")
+
+def migracion_archivo_logs(conn):
+    # Segmentos archivados de audit_logs y su índice por paso
+    conn.execute('''CREATE TABLE IF NOT EXISTS log_segments (
+        id INTEGER PRIMARY KEY,
+        file_name TEXT,
+        rows INTEGER,
+        first_log_id INTEGER,
+        last_log_id INTEGER,
+        prev_hash TEXT,
+        chain_hash TEXT,
+        created DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS log_segment_index (
+        step_id INTEGER,
+        segment_id INTEGER REFERENCES log_segments(id),
+        offset INTEGER,
+        length INTEGER,
+        rows INTEGER,
+        block_hash TEXT,
+        PRIMARY KEY (step_id, segment_id))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_segment_index_segmento ON log_segment_index (segment_id, offset)")
+
+def migracion_resumen_progreso(conn):
+    # Resumen por cliente y área mantenido por triggers; el panel principal lo lee sin tocar audit_steps
+    conn.execute('''CREATE TABLE IF NOT EXISTS client_progress (
+        client_id INTEGER,
+        area_name TEXT,
+        sin_iniciar INTEGER NOT NULL DEFAULT 0,
+        en_proceso INTEGER NOT NULL DEFAULT 0,
+        terminado INTEGER NOT NULL DEFAULT 0,
+        evidencias INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (client_id, area_name))''')
+
+    def aporte(fila, signo):
+        # SET que suma (o resta) la contribución de una fila de audit_steps
+        return (f"sin_iniciar = sin_iniciar {signo} ({fila}.status = 'Sin Iniciar'), "
+                f"en_proceso = en_proceso {signo} ({fila}.status = 'En Proceso'), "
+                f"terminado = terminado {signo} ({fila}.status = 'Terminado'), "
+                f"evidencias = evidencias {signo} (SELECT COUNT(*) FROM audit_evidence WHERE step_id = {fila}.id)")
+    alta = """INSERT INTO client_progress (client_id, area_name) SELECT new.client_id, new.area_name WHERE new.is_deleted = 0 ON CONFLICT DO NOTHING;
+        UPDATE client_progress SET {} WHERE new.is_deleted = 0 AND client_id = new.client_id AND area_name = new.area_name;""".format(aporte("new", "+"))
+    baja = "UPDATE client_progress SET {} WHERE old.is_deleted = 0 AND client_id = old.client_id AND area_name = old.area_name;".format(aporte("old", "-"))
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_progreso_ins AFTER INSERT ON audit_steps BEGIN {alta} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_progreso_del AFTER DELETE ON audit_steps BEGIN {baja} END")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_progreso_upd AFTER UPDATE OF status, is_deleted, area_name, client_id ON audit_steps
+        WHEN old.status IS NOT new.status OR old.is_deleted IS NOT new.is_deleted OR old.area_name IS NOT new.area_name OR old.client_id IS NOT new.client_id
+        BEGIN {baja} {alta} END""")
+    paso = "(SELECT client_id, area_name FROM audit_steps WHERE id = {}.step_id AND is_deleted = 0)"
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_progreso_ev_ins AFTER INSERT ON audit_evidence BEGIN
+        UPDATE client_progress SET evidencias = evidencias + 1 WHERE (client_id, area_name) = {paso.format('new')}; END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_progreso_ev_del AFTER DELETE ON audit_evidence BEGIN
+        UPDATE client_progress SET evidencias = evidencias - 1 WHERE (client_id, area_name) = {paso.format('old')}; END""")
+    reconstruir_resumen_progreso(conn)
+
+# Ámbito de cada base: la monolítica lo tiene todo; en modo shards se separan catálogo y clientes
+AMBITO_COMPLETO, AMBITO_CATALOGO, AMBITO_CLIENTE = 'completo', 'catalogo', 'cliente'
+AMBOS = (AMBITO_CATALOGO, AMBITO_CLIENTE)
+
+# Cada posición corresponde a una versión de PRAGMA user_version: solo se agregan al final.
+# La versión 1 crea el esquema completo en toda base; las tablas fuera de su ámbito quedan vacías.
+MIGRACIONES = [(create_tables, AMBOS), (migracion_evidencias_en_disco, (AMBITO_CLIENTE,)), (migracion_indices, (AMBITO_CLIENTE,)),
+               (migracion_indice_codigos, (AMBITO_CLIENTE,)), (migracion_busqueda_texto, (AMBITO_CLIENTE,)),
+               (migracion_claves_paginacion, (AMBITO_CLIENTE,)), (migracion_version_pasos, (AMBITO_CLIENTE,)),
+               (migracion_archivo_logs, (AMBITO_CLIENTE,)), (migracion_resumen_progreso, (AMBITO_CLIENTE,))]
+
+def migrar_base(conn, ambito=AMBITO_COMPLETO):
+    """Aplica sobre `conn` las migraciones pendientes de su ámbito; las ajenas solo avanzan la versión."""
+    aplicadas = 0
+    # Base al día (el caso habitual al abrir un shard): sin transacciones de escritura
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRACIONES): return aplicadas
+    for numero, (migracion, ambitos) in enumerate(MIGRACIONES, start=1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Se relee dentro de la transacción por si otro proceso ya migró
+            if conn.execute("PRAGMA user_version").fetchone()[0] < numero:
+                if ambito == AMBITO_COMPLETO or ambito in ambitos: migracion(conn)
+                conn.execute(f"PRAGMA user_version = {numero}")
+                aplicadas += 1
+        except BaseException:
+            conn.rollback(); raise
+        conn.commit()
+    if aplicadas and conn.execute("PRAGMA freelist_count").fetchone()[0] > 1000: conn.execute("VACUUM")
+    return aplicadas
+
+def aplicar_migraciones():
+    # Base principal; los shards se migran al abrirse (preparar_shard)
+    return migrar_base(obtener_pool().obtener(ruta_base()), AMBITO_CATALOGO if MODO_SHARDS else AMBITO_COMPLETO)
+
+def sembrar_secuencias(conn, client_id):
+    # Los ids nuevos de un shard arrancan en client_id * BLOQUE_IDS; los ya migrados conservan los suyos
+    conn.execute("BEGIN IMMEDIATE")
+    for tabla in ("audit_steps", "audit_logs", "audit_evidence"):
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name=?)", (tabla, tabla))
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name=?", (client_id * BLOQUE_IDS, tabla))
     conn.commit()
-    conn.close()
+
+def _copiar_tabla(conn, tabla, condicion, params):
+    # Copia desde la base adjunta `origen` con las columnas del destino (ambas migradas a la misma versión)
+    columnas = ", ".join(c[1] for c in conn.execute(f"PRAGMA main.table_info({tabla})"))
+    return conn.execute(f"INSERT INTO main.{tabla} ({columnas}) SELECT {columnas} FROM origen.{tabla} WHERE {condicion}", params).rowcount
+
+def dividir_en_shards(origen=DB_PATH, al_progresar=None):
+    """Reparte una base monolítica en catálogo (users, clients) y un archivo por cliente.
+
+    La base de origen no se modifica (queda como respaldo). Los ids se conservan;
+    el índice FTS y client_progress se reconstruyen con los triggers al copiar.
+    Los registros ya archivados se devuelven a audit_logs del cliente, porque la
+    cadena de segmentos original mezcla clientes; conviene archivarlos de nuevo por cliente.
+    """
+    if not os.path.exists(origen): raise FileNotFoundError(origen)
+    if os.path.exists(CATALOGO_PATH): raise FileExistsError(f"{CATALOGO_PATH} ya existe; la división se hace una sola vez")
+    fuente = get_db_connection(origen)
+    migrar_base(fuente, AMBITO_COMPLETO)
+    clientes = [c for (c,) in fuente.execute("SELECT id FROM clients ORDER BY id")]
+    resumen = {'clientes': len(clientes), 'pasos': 0, 'evidencias': 0, 'logs': 0, 'logs_archivados': 0}
+
+    catalogo = get_db_connection(CATALOGO_PATH)
+    migrar_base(catalogo, AMBITO_CATALOGO)
+    catalogo.execute("ATTACH DATABASE ? AS origen", (origen,))
+    catalogo.execute("BEGIN IMMEDIATE")
+    for tabla in ("users", "clients"): _copiar_tabla(catalogo, tabla, "1", ())
+    catalogo.commit()
+    catalogo.execute("DETACH DATABASE origen"); catalogo.close()
+
+    os.makedirs(SHARDS_DIR, exist_ok=True)
+    de_cliente = "step_id IN (SELECT id FROM origen.audit_steps WHERE client_id=?)"
+    for n, cid in enumerate(clientes, 1):
+        ruta = ruta_base(cid, shards=True)
+        if os.path.exists(ruta): raise FileExistsError(ruta)
+        conn = get_db_connection(ruta)
+        try:
+            migrar_base(conn, AMBITO_CLIENTE)
+            conn.execute("ATTACH DATABASE ? AS origen", (origen,))
+            conn.execute("BEGIN IMMEDIATE")
+            resumen['pasos'] += _copiar_tabla(conn, "audit_steps", "client_id=?", (cid,))
+            resumen['evidencias'] += _copiar_tabla(conn, "audit_evidence", de_cliente, (cid,))
+            resumen['logs'] += _copiar_tabla(conn, "audit_logs", de_cliente, (cid,))
+            _copiar_tabla(conn, "materiality", "client_id=?", (cid,))
+            for (step_id,) in fuente.execute("SELECT DISTINCT step_id FROM log_segment_index WHERE step_id IN (SELECT id FROM audit_steps WHERE client_id=?)", (cid,)):
+                filas = [tuple(r[c] for c in COLUMNAS_LOG) for r in leer_archivo_paso(fuente, step_id)]
+                conn.executemany(f"INSERT INTO audit_logs ({', '.join(COLUMNAS_LOG)}) VALUES ({', '.join('?' * len(COLUMNAS_LOG))})", filas)
+                resumen['logs_archivados'] += len(filas)
+            conn.commit()
+            conn.execute("DETACH DATABASE origen")
+            sembrar_secuencias(conn, cid)
+        finally:
+            conn.close()
+        if al_progresar: al_progresar(n / len(clientes), f"Cliente {cid}: {n:,} de {len(clientes):,}")
+    fuente.close()
+    return resumen
+
+# Rutas críticas que deben resolverse con índice (se revisan con EXPLAIN QUERY PLAN)
+CONSULTAS_INDEXADAS = {
+    'pasos_cliente': ("SELECT * FROM audit_steps WHERE client_id=? AND is_deleted=0 ORDER BY section_name ASC, area_name ASC, step_code ASC", (1,)),
+    'pagina_pasos': ("SELECT s.* FROM audit_steps s WHERE s.client_id=? AND s.is_deleted=0 AND (s.section_name, s.area_name, s.step_code, s.id) > (?, ?, ?, ?) ORDER BY s.section_name, s.area_name, s.step_code, s.id LIMIT 41", (1, '', '', '', 0)),
+    'evidencias_paso': ("SELECT id, file_name FROM audit_evidence WHERE step_id=?", (1,)),
+    'historial_paso': ("SELECT timestamp, user_name, action FROM audit_logs WHERE step_id=? ORDER BY timestamp DESC", (1,)),
+}
+
+def verificar_planes_consulta(conn):
+    """Devuelve {consulta: (usa_indice, detalle)}; usa_indice es False ante un SCAN completo o un ordenamiento temporal."""
+    resultado = {}
+    for nombre, (sql, params) in CONSULTAS_INDEXADAS.items():
+        detalle = [fila[3] for fila in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        usa_indice = any("INDEX" in d for d in detalle) and not any(d.startswith("SCAN") or "TEMP B-TREE" in d for d in detalle)
+        resultado[nombre] = (usa_indice, detalle)
+    return resultado
 
 # --- SCRIPT DE INICIALIZACIÓN ---
 def crear_admin_por_defecto():
-    conn = get_db_connection()
-    cursor = conn.cursor()
     usuarios = [
         ('admin@auditpro.com', 'Administrador Principal', 'admin123', 'Administrador'),
         ('auditgerencial.rojas@outlook.com', 'Gerencia Auditoría', 'admin123', 'Administrador')
     ]
-    for email, nombre, clave, rol in usuarios:
-        cursor.execute("SELECT * FROM users WHERE email=?", (email,))
-        if not cursor.fetchone():
-            ph = hashlib.sha256(clave.encode()).hexdigest()
-            cursor.execute("INSERT INTO users (email, full_name, password_hash, role) VALUES (?,?,?,?)", (email, nombre, ph, rol))
-    conn.commit(); conn.close()
+    with transaccion() as conn:
+        cursor = conn.cursor()
+        for email, nombre, clave, rol in usuarios:
+            cursor.execute("SELECT * FROM users WHERE email=?", (email,))
+            if not cursor.fetchone():
+                ph = hashlib.sha256(clave.encode()).hexdigest()
+                cursor.execute("INSERT INTO users (email, full_name, password_hash, role) VALUES (?,?,?,?)", (email, nombre, ph, rol))
+
+# Streamlit reejecuta el módulo en cada interacción: la inicialización corre una vez por proceso
+@st.cache_resource
+def inicializar_base_datos():
+    aplicar_migraciones()
+    crear_admin_por_defecto()
+    return True
 
-create_tables()
-crear_admin_por_defecto()
+inicializar_base_datos()
 
 # --- LÓGICA DE NEGOCIO ---
+def autenticar(email, clave):
+    with conexion() as conn:
+        return conn.execute("SELECT id, full_name, role FROM users WHERE email=? AND password_hash=?", 
+                            (email.strip().lower(), hashlib.sha256(clave.strip().encode()).hexdigest())).fetchone()
+
 def cargar_pasos_iniciales(conn, client_id):
     pasos = [
        ("Planeación", "Aceptación", "1000", "(ISA 220, 300) Evaluar aceptación", "Realice evaluación de riesgos."),
@@ -131,72 +946,577 @@ def cargar_pasos_iniciales(conn, client_id):
        ("Planeación", "Ética", "4000", "(ISA 200) Requisitos éticos", "Documentar independencia."),
        ("Planeación", "Contratación", "5000", "(ISA 210) Carta encargo", "Verificar firma representante.")
     ]
-    cursor = conn.cursor()
-    for p in pasos:
-        cursor.execute("INSERT INTO audit_steps (client_id, section_name, area_name, step_code, description, instructions) VALUES (?, ?, ?, ?, ?, ?)", (client_id, p[0], p[1], p[2], p[3], p[4]))
-    conn.commit()
+    conn.executemany("INSERT INTO audit_steps (client_id, section_name, area_name, step_code, description, instructions) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(client_id, p[0], p[1], p[2], p[3], p[4]) for p in pasos])
 
-def actualizar_paso_seguro(step_id, user_id, user_name, nuevas_notas, nuevo_estado):
-    conn = get_db_connection(); cursor = conn.cursor()
-    cursor.execute("SELECT user_notes, status FROM audit_steps WHERE id=?", (step_id,))
-    actual = cursor.fetchone()
-    if not actual: return False
-    
-    n_ant, e_ant = actual[0] or "", actual[1]
+def _describir_cambios(n_ant, e_ant, nuevas_notas, nuevo_estado):
     cambios = []
     if (n_ant.strip() != nuevas_notas.strip()): cambios.append("Notas actualizadas")
     if e_ant != nuevo_estado: cambios.append(f"Estado: {e_ant} -> {nuevo_estado}")
-    
-    if cambios:
-        cursor.execute("UPDATE audit_steps SET user_notes=?, status=? WHERE id=?", (nuevas_notas, nuevo_estado, step_id))
-        desc = " | ".join(cambios)
-        cursor.execute("INSERT INTO audit_logs (step_id, user_id, user_name, action, previous_value, new_value) VALUES (?,?,?,?,?,?)", 
-                       (step_id, user_id, user_name, desc, n_ant[:50], nuevas_notas[:50]))
-        conn.commit(); ret = True
-    else: ret = False
-    conn.close(); return ret
-
-def guardar_evidencia(step_id, user_id, uploaded_file):
+    return " | ".join(cambios)
+
+def guardar_cambios_lote(cambios, user_id, user_name, client_id=None):
+    """Aplica en una sola transacción las ediciones {step_id: (notas, estado, version)}.
+
+    ``version`` es la que tenía el paso cuando el auditor lo leyó (None omite la
+    verificación). Devuelve (guardados, conflictos): los ids actualizados y los
+    que otro usuario modificó entretanto, que se dejan intactos. En modo shards
+    ``client_id`` indica el archivo de los pasos.
+    """
+    if not cambios: return [], []
+    with transaccion(client_id) as conn:
+        actuales = {sid: (notas or "", estado, version, cid) for sid, notas, estado, version, cid in conn.execute(
+            "SELECT id, user_notes, status, version, client_id FROM audit_steps WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(cambios)),))}
+        updates, logs, conflictos, clientes = [], [], [], set()
+        for sid, (notas, estado, version) in cambios.items():
+            if sid not in actuales or (version is not None and actuales[sid][2] != version):
+                conflictos.append(sid); continue
+            n_ant, e_ant, v_act, cid = actuales[sid]
+            desc = _describir_cambios(n_ant, e_ant, notas, estado)
+            if not desc: continue
+            updates.append((notas, estado, sid, v_act))
+            logs.append((sid, user_id, user_name, desc, n_ant[:50], notas[:50]))
+            clientes.add(cid)
+        conn.executemany("UPDATE audit_steps SET user_notes=?, status=?, version=version+1 WHERE id=? AND version=?", updates)
+        conn.executemany("INSERT INTO audit_logs (step_id, user_id, user_name, action, previous_value, new_value) VALUES (?,?,?,?,?,?)", logs)
+    invalidar_cliente(*clientes)
+    return [u[2] for u in updates], conflictos
+
+def actualizar_paso_seguro(step_id, user_id, user_name, nuevas_notas, nuevo_estado, version=None, client_id=None):
+    guardados, _ = guardar_cambios_lote({step_id: (nuevas_notas, nuevo_estado, version)}, user_id, user_name, client_id)
+    return bool(guardados)
+
+def _retirar_si_huerfano(file_hash, client_id=None):
+    # Borra el archivo si ninguna evidencia lo referencia; se llama con obtener_lock_almacen() tomado
+    with conexion(client_id) as conn:
+        en_uso = conn.execute("SELECT 1 FROM audit_evidence WHERE file_hash=? LIMIT 1", (file_hash,)).fetchone()
+    # En modo shards el almacén es común: el archivo puede estar referenciado desde otro cliente
+    if MODO_SHARDS and not en_uso:
+        en_uso = consultar_clientes("SELECT 1 FROM {base}.audit_evidence WHERE file_hash=? LIMIT 1", (file_hash,), incluir_eliminados=True)
+    if not en_uso and os.path.exists(ruta_evidencia(file_hash)): os.remove(ruta_evidencia(file_hash))
+
+def guardar_evidencia(step_id, user_id, uploaded_file, client_id=None):
     if uploaded_file is not None:
         try:
-            bytes_data = uploaded_file.getvalue()
-            conn = get_db_connection()
-            conn.execute("INSERT INTO audit_evidence (step_id, user_id, file_name, file_type, file_data) VALUES (?,?,?,?,?)",
-                         (step_id, user_id, uploaded_file.name, uploaded_file.type, bytes_data))
-            conn.commit(); conn.close()
+            uploaded_file.seek(0)
+            tmp, file_hash, tam = copiar_temporal(uploaded_file)
+            # Un borrado concurrente podría quitar el archivo deduplicado entre la publicación y el INSERT
+            with obtener_lock_almacen():
+                with conexion(client_id) as conn:
+                    paso = conn.execute("SELECT client_id FROM audit_steps WHERE id=?", (step_id,)).fetchone()
+                if paso is None:
+                    os.remove(tmp); st.error("El procedimiento ya no existe."); return False
+                try: publicar_archivo(tmp, file_hash)
+                except OSError:
+                    os.remove(tmp); raise
+                try:
+                    with transaccion(client_id) as conn:
+                        conn.execute("INSERT INTO audit_evidence (step_id, user_id, file_name, file_type, file_hash, file_size) VALUES (?,?,?,?,?,?)",
+                                     (step_id, user_id, uploaded_file.name, uploaded_file.type, file_hash, tam))
+                except Exception:
+                    _retirar_si_huerfano(file_hash, client_id); raise
+            invalidar_cliente(paso[0])
             return True
         except Exception as e:
             st.error(f"Error al subir: {e}")
             return False
     return False
 
-def eliminar_evidencia(file_id):
-    conn = get_db_connection()
+def eliminar_evidencia(file_id, client_id=None):
     try:
-        conn.execute("DELETE FROM audit_evidence WHERE id=?", (file_id,))
-        conn.commit()
-    except: pass
-    finally: conn.close()
+        with obtener_lock_almacen():
+            with transaccion(client_id) as conn:
+                fila = conn.execute("SELECT e.file_hash, s.client_id FROM audit_evidence e JOIN audit_steps s ON s.id = e.step_id WHERE e.id=?", (file_id,)).fetchone()
+                conn.execute("DELETE FROM audit_evidence WHERE id=?", (file_id,))
+            if fila and fila[0]: _retirar_si_huerfano(fila[0], client_id)
+        if fila: invalidar_cliente(fila[1])
+        return True
+    except (sqlite3.Error, OSError) as e:
+        st.error(f"Error al eliminar la evidencia: {e}")
+        return False
+
+# --- ACCESO A DATOS: PROGRAMA DE TRABAJO ---
+LOGS_RECIENTES = 10
+TAM_PAGINA = 40
+
+def _filtros_pasos(client_id, seccion=None, area=None, estado=None, texto=""):
+    # Los filtros se resuelven en SQL; el texto usa el índice FTS5
+    condiciones, params = ["s.client_id = ?", "s.is_deleted = 0"], [client_id]
+    if seccion: condiciones.append("s.section_name = ?"); params.append(seccion)
+    if area: condiciones.append("s.area_name = ?"); params.append(area)
+    if estado: condiciones.append("s.status = ?"); params.append(estado)
+    consulta = consulta_fts(texto or "")
+    if consulta:
+        condiciones.append("s.id IN (SELECT rowid FROM audit_steps_fts WHERE audit_steps_fts MATCH ?)"); params.append(consulta)
+    return " AND ".join(condiciones), params
+
+def listar_secciones_areas(conn, client_id):
+    return conn.execute("SELECT DISTINCT section_name, area_name FROM audit_steps WHERE client_id=? AND is_deleted=0 ORDER BY section_name, area_name", (client_id,)).fetchall()
+
+def contar_pasos_por_area(conn, client_id, **filtros):
+    where, params = _filtros_pasos(client_id, **filtros)
+    cur = conn.execute(f"SELECT s.section_name, s.area_name, COUNT(*) FROM audit_steps s WHERE {where} GROUP BY s.section_name, s.area_name", params)
+    return {(sec, area): n for sec, area, n in cur}
+
+def cargar_programa_trabajo(conn, client_id, despues=None, tam_pagina=TAM_PAGINA, **filtros):
+    """Carga una página del programa en un número fijo de consultas.
+
+    La paginación es por clave (sección, área, código, id): ``despues`` es la
+    clave de la última fila de la página anterior. Devuelve la página de pasos,
+    si hay más filas, y dos diccionarios indexados por step_id: metadatos de
+    evidencias y las últimas LOGS_RECIENTES entradas del historial.
+    """
+    where, params = _filtros_pasos(client_id, **filtros)
+    if despues:
+        where += " AND (s.section_name, s.area_name, s.step_code, s.id) > (?, ?, ?, ?)"; params += list(despues)
+    steps = pd.read_sql_query(f"SELECT s.* FROM audit_steps s WHERE {where} ORDER BY s.section_name ASC, s.area_name ASC, s.step_code ASC, s.id ASC LIMIT ?",
+                              conn, params=params + [tam_pagina + 1])
+    hay_mas = len(steps) > tam_pagina
+    steps = steps.iloc[:tam_pagina]
+    ids = [int(i) for i in steps['id']]
+    return steps, hay_mas, listar_evidencias(conn, ids), historial_reciente(conn, ids)
+
+def listar_evidencias(conn, step_ids):
+    # Solo metadatos: el contenido se lee del almacén al descargar
+    evidencias = {}
+    cur = conn.execute("""SELECT id, step_id, file_name, file_type, file_hash, file_size, upload_date
+        FROM audit_evidence WHERE step_id IN (SELECT value FROM json_each(?)) ORDER BY step_id, id""", (json.dumps(step_ids),))
+    for ev_id, step_id, nombre, tipo, file_hash, tam, fecha in cur:
+        evidencias.setdefault(step_id, []).append({'id': ev_id, 'file_name': nombre, 'file_type': tipo, 'file_hash': file_hash, 'file_size': tam, 'upload_date': fecha})
+    return evidencias
+
+def historial_reciente(conn, step_ids, limite=LOGS_RECIENTES):
+    logs = {}
+    cur = conn.execute("""SELECT step_id, timestamp, user_name, action FROM (
+            SELECT step_id, timestamp, user_name, action,
+                   ROW_NUMBER() OVER (PARTITION BY step_id ORDER BY timestamp DESC, id DESC) AS n
+            FROM audit_logs WHERE step_id IN (SELECT value FROM json_each(?)))
+        WHERE n <= ? ORDER BY step_id, n""", (json.dumps(step_ids), limite))
+    for step_id, fecha, usuario, accion in cur:
+        logs.setdefault(step_id, []).append((fecha, usuario, accion))
+    return logs
+
+# --- BÚSQUEDA DE TEXTO COMPLETO (FTS5) ---
+def consulta_fts(texto):
+    # Cada palabra se busca como prefijo; las comillas neutralizan la sintaxis FTS5 del usuario
+    return " ".join(f'"{t}"*' for t in re.findall(r"\w+", texto))
+
+COLUMNAS_BUSQUEDA = ['id', 'client_id', 'client_name', 'section_name', 'area_name', 'step_code', 'description', 'status', 'fragmento', 'rango']
+
+def buscar_procedimientos(texto, client_id=None, limite=50):
+    """Busca en código, descripción, instrucciones y notas, ordenado por relevancia (bm25).
+
+    Sin client_id la búsqueda abarca todos los clientes activos. El fragmento
+    resalta las coincidencias en negrita (Markdown).
+    """
+    consulta = consulta_fts(texto)
+    if not consulta: return pd.DataFrame(columns=COLUMNAS_BUSQUEDA[:-1])
+    filtro, params = "", [consulta]
+    if client_id is not None: filtro, params = "AND s.client_id = ?", params + [client_id]
+    # En modo shards cada tanda de clientes devuelve sus mejores resultados y el corte final se hace aquí
+    filas = consultar_clientes(f"""SELECT s.id, s.client_id, c.client_name, s.section_name, s.area_name, s.step_code, s.description, s.status,
+            snippet(audit_steps_fts, -1, '**', '**', '…', 16) AS fragmento, bm25(audit_steps_fts, 10.0, 4.0, 1.0, 2.0) AS rango
+        FROM {{base}}.audit_steps_fts
+        JOIN {{base}}.audit_steps s ON s.id = audit_steps_fts.rowid
+        JOIN clients c ON c.id = s.client_id
+        WHERE audit_steps_fts MATCH ? AND c.is_deleted = 0 {filtro}
+        ORDER BY rango LIMIT ?""", params + [limite], client_ids=None if client_id is None else [client_id])
+    return pd.DataFrame(filas, columns=COLUMNAS_BUSQUEDA).sort_values('rango', kind='stable').head(limite).drop(columns='rango')
+
+# --- IMPORTACIÓN MASIVA (por lotes) ---
+COLUMNAS_IMPORTACION = ['Seccion', 'Area', 'Codigo', 'Descripcion', 'Instrucciones']
+COLUMNAS_OBLIGATORIAS = ['Codigo', 'Descripcion']
+TAM_LOTE_IMPORTACION = 5000
+
+def _validar_encabezado(columnas):
+    faltantes = [c for c in COLUMNAS_OBLIGATORIAS if c not in columnas]
+    if faltantes: raise ValueError(f"Faltan columnas obligatorias: {', '.join(faltantes)}")
+
+def _nombres_columnas(crudos):
+    # Como pandas: celdas vacías -> "Unnamed: N" y repetidas -> "Nombre.1"; solo cuenta la primera
+    nombres, vistos = [], collections.Counter()
+    for i, valor in enumerate(crudos):
+        nombre = _celda(valor).strip() or f"Unnamed: {i}"
+        nombres.append(f"{nombre}.{vistos[nombre]}" if vistos[nombre] else nombre); vistos[nombre] += 1
+    return nombres
+
+def leer_lotes_csv(archivo, tam_lote=TAM_LOTE_IMPORTACION):
+    # Genera (lote, avance) leyendo el CSV por bloques; todo se lee como texto
+    total = getattr(archivo, 'size', None) or 0
+    lotes = pd.read_csv(archivo, chunksize=tam_lote, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    for lote in lotes:
+        lote.columns = _nombres_columnas(lote.columns)
+        _validar_encabezado(lote.columns)
+        yield lote, min(archivo.tell() / total, 1.0) if total else None
+
+def _celda(valor):
+    # Excel devuelve los códigos numéricos como float (101.0)
+    if isinstance(valor, float) and valor.is_integer(): return str(int(valor))
+    return "" if valor is None else str(valor)
+
+def leer_lotes_excel(archivo, tam_lote=TAM_LOTE_IMPORTACION):
+    import openpyxl
+    wb = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        filas = ws.iter_rows(values_only=True)
+        encabezado = _nombres_columnas(next(filas, ()))
+        _validar_encabezado(encabezado)
+        total, leidas, bloque = ws.max_row or 0, 1, []
+        for fila in filas:
+            bloque.append([_celda(c) for c in fila[:len(encabezado)]])
+            leidas += 1
+            if len(bloque) == tam_lote:
+                yield pd.DataFrame(bloque, columns=encabezado), leidas / total if total else None
+                bloque = []
+        if bloque: yield pd.DataFrame(bloque, columns=encabezado), 1.0
+    finally:
+        wb.close()
+
+def normalizar_lote(lote, primera_fila):
+    """Limpia un lote y lo separa en filas válidas y rechazadas (fila, motivo)."""
+    lote = lote.reindex(columns=COLUMNAS_IMPORTACION).fillna("").astype(str).apply(lambda c: c.str.strip())
+    lote['fila'] = range(primera_fila, primera_fila + len(lote))
+    lote.loc[lote['Seccion'] == "", 'Seccion'] = "General"
+    lote.loc[lote['Area'] == "", 'Area'] = "General"
+
+    motivos = pd.Series("", index=lote.index)
+    motivos[lote['Descripcion'] == ""] = "Descripción vacía"
+    motivos[lote['Codigo'] == ""] = "Código vacío"
+    rechazados = list(zip(lote.loc[motivos != "", 'fila'], motivos[motivos != ""]))
+    validos = lote.loc[motivos == "", ['fila', 'Seccion', 'Area', 'Codigo', 'Descripcion', 'Instrucciones']]
+    return list(validos.itertuples(index=False, name=None)), rechazados
+
+def importar_procedimientos(client_id, archivo, nombre_archivo, al_progresar=None):
+    """Importa un CSV/XLSX por lotes y devuelve el resumen de insertados, duplicados y rechazados.
+
+    Las filas válidas se acumulan en una tabla temporal; los duplicados (contra el
+    cliente y dentro del mismo archivo) se descartan en SQL con un único INSERT ... SELECT.
+    """
+    lector = leer_lotes_csv if nombre_archivo.lower().endswith('.csv') else leer_lotes_excel
+    resumen = {'insertados': 0, 'duplicados': 0, 'rechazados': []}
+    with conexion(client_id) as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS importacion_staging (fila INTEGER PRIMARY KEY, section_name TEXT, area_name TEXT, step_code TEXT, description TEXT, instructions TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS temp.idx_staging_codigo ON importacion_staging (step_code, fila)")
+        conn.execute("DELETE FROM importacion_staging")
+        try:
+            primera, validas = 2, 0
+            for lote, avance in lector(archivo):
+                filas, rechazados = normalizar_lote(lote, primera)
+                conn.executemany("INSERT INTO importacion_staging VALUES (?,?,?,?,?,?)", filas)
+                resumen['rechazados'].extend(rechazados)
+                primera += len(lote); validas += len(filas)
+                if al_progresar: al_progresar(avance, primera - 2)
+
+            with transaccion(client_id):
+                cur = conn.execute("""INSERT INTO audit_steps (client_id, section_name, area_name, step_code, description, instructions)
+                    SELECT ?, s.section_name, s.area_name, s.step_code, s.description, s.instructions
+                    FROM importacion_staging s
+                    WHERE s.fila = (SELECT MIN(d.fila) FROM importacion_staging d WHERE d.step_code = s.step_code)
+                      AND NOT EXISTS (SELECT 1 FROM audit_steps a WHERE a.client_id = ? AND a.step_code = s.step_code)
+                    ORDER BY s.fila""", (client_id, client_id))
+                resumen['insertados'] = cur.rowcount
+            resumen['duplicados'] = validas - resumen['insertados']
+            invalidar_cliente(client_id)
+        finally:
+            conn.execute("DELETE FROM importacion_staging")
+    return resumen
+
+# --- MATERIALIDAD DE LA CARTERA (vectorizada con NumPy) ---
+# (% mínimo, % máximo, % sugerido): límites de los sliders del módulo de materialidad y de la validación de la cartera
+RANGOS_BENCHMARK = {"Utilidad Neta": (0.0, 10.0, 5.0), "Ingresos Totales": (0.0, 5.0, 2.5), "Activos Totales": (0.0, 5.0, 2.5), "EBITDA": (0.0, 5.0, 2.5)}
+RANGO_PERFORMANCE = (0.0, 75.0, 50.0)  # sobre la materialidad general
+RANGO_RANR = (0.0, 10.0, 5.0)
+TOLERANCIA_MATERIALIDAD = 0.01  # diferencia admitida entre el monto guardado y el recalculado
+
+COLUMNAS_CARTERA = ['client_id', 'client_name', 'benchmark', 'benchmark_value', 'p_general', 'mat_general', 'p_performance', 'mat_performance', 'p_ranr', 'mat_ranr']
+
+def cargar_cartera_materialidad():
+    """Materialidad guardada de todos los clientes activos como arreglos NumPy alineados por posición."""
+    filas = consultar_clientes("""SELECT c.id, c.client_name, m.benchmark, m.benchmark_value, m.p_general, m.mat_general,
+            m.p_performance, m.mat_performance, m.p_ranr, m.mat_ranr
+        FROM {base}.materiality m JOIN clients c ON c.id = m.client_id WHERE c.is_deleted=0""")
+    df = pd.DataFrame(filas, columns=COLUMNAS_CARTERA).sort_values('client_name', kind='stable')
+    cartera = {col: df[col].to_numpy(dtype=float) for col in df.columns if col not in ('client_id', 'client_name', 'benchmark')}
+    cartera.update(client_id=df['client_id'].to_numpy(), client_name=df['client_name'].to_numpy(), benchmark=df['benchmark'].to_numpy())
+    rangos = np.array([RANGOS_BENCHMARK.get(b, (np.nan, np.nan, np.nan))[:2] for b in cartera['benchmark']], dtype=float).reshape(-1, 2)
+    cartera['p_min'], cartera['p_max'] = rangos[:, 0], rangos[:, 1]
+    return cartera
+
+def validar_umbrales(cartera):
+    """Motivos de alerta por cliente (lista de textos, vacía si todo está en rango)."""
+    p_gen, p_perf, p_ranr = cartera['p_general'], cartera['p_performance'], cartera['p_ranr']
+    # Un 0 % deja el umbral en cero; NaN (benchmark desconocido) también cuenta como fuera
+    fuera = lambda v, lo, hi, *_: ~((v > lo) & (v <= hi))
+    esperado = cartera['benchmark_value'] * p_gen / 100
+    reglas = [
+        (fuera(p_gen, cartera['p_min'], cartera['p_max']), "% general fuera del rango del benchmark"),
+        (fuera(p_perf, *RANGO_PERFORMANCE), f"% performance fuera de {RANGO_PERFORMANCE[0]:g}–{RANGO_PERFORMANCE[1]:g} %"),
+        (fuera(p_ranr, *RANGO_RANR), f"% RANR fuera de {RANGO_RANR[0]:g}–{RANGO_RANR[1]:g} %"),
+        (~np.isclose(cartera['mat_general'], esperado, rtol=TOLERANCIA_MATERIALIDAD), "Mat. general no coincide con el valor base"),
+        (~np.isclose(cartera['mat_performance'], esperado * p_perf / 100, rtol=TOLERANCIA_MATERIALIDAD), "Mat. performance desactualizada"),
+        (~np.isclose(cartera['mat_ranr'], esperado * p_ranr / 100, rtol=TOLERANCIA_MATERIALIDAD), "Umbral RANR desactualizado"),
+    ]
+    motivos = [[] for _ in range(len(p_gen))]
+    for mascara, texto in reglas:
+        for i in np.flatnonzero(mascara): motivos[i].append(texto)
+    return motivos
+
+def rejilla_porcentajes(minimo, maximo, pasos):
+    # Equiespaciada en (mínimo, máximo]: el extremo inferior no es un umbral admitido
+    return minimo + (maximo - minimo) * np.arange(1, pasos + 1) / pasos
+
+def resumen_sensibilidad(cartera, pasos_general=11, pasos_performance=11, pasos_ranr=11):
+    """Mínimo, mediana y máximo por cliente de cada umbral sobre la rejilla general x performance x RANR.
+
+    Cada umbral es valor base x factor y el factor solo depende del rango del benchmark: sus estadísticas
+    se calculan una vez por rango (a lo sumo pasos_general x pasos_performance valores), nunca clientes x escenarios.
+    """
+    validos = ~np.isnan(cartera['p_min'])  # benchmark desconocido: sin escenarios
+    resumen = pd.DataFrame({'Cliente': cartera['client_name'], 'Benchmark': cartera['benchmark'], 'Mat. General guardada': cartera['mat_general']})
+    performance = rejilla_porcentajes(*RANGO_PERFORMANCE[:2], pasos_performance) / 100
+    ranr = rejilla_porcentajes(*RANGO_RANR[:2], pasos_ranr) / 100
+    rangos, grupo = np.unique(np.column_stack([cartera['p_min'], cartera['p_max']])[validos], axis=0, return_inverse=True)
+    # La tercera dimensión de la rejilla solo repite valores: no cambia mínimo, mediana ni máximo
+    factores = {'general': [], 'performance': [], 'ranr': []}
+    for p_min, p_max in rangos:
+        general = rejilla_porcentajes(p_min, p_max, pasos_general) / 100
+        for clave, f in (('general', general), ('performance', np.outer(general, performance)), ('ranr', np.outer(general, ranr))):
+            factores[clave].append((f.min(), np.median(f), f.max()))
+    valor = cartera['benchmark_value'][validos, None]
+    for clave, etiqueta in (('general', "Mat. General"), ('performance', "Performance"), ('ranr', "RANR")):
+        # Un valor base negativo invierte el orden: se reordena tras escalar
+        estadisticas = np.sort(valor * np.array(factores[clave]).reshape(-1, 3)[grupo.reshape(-1)], axis=1)
+        for i, sufijo in enumerate(("mín", "mediana", "máx")):
+            columna = np.full(len(validos), np.nan)
+            columna[validos] = estadisticas[:, i]
+            resumen[f"{etiqueta} {sufijo}"] = columna
+    return resumen
+
+# --- EXPORTACIÓN DEL EXPEDIENTE (en segundo plano) ---
+EXPORT_DIR = 'exportaciones'
+FORMATOS_EXPORTACION = {
+    'xlsx': ("Excel: programa, bitácora y materialidad", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    'pdf': ("PDF del expediente", "application/pdf"),
+    'docx': ("Word del expediente", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    'zip': ("ZIP con todas las evidencias", "application/zip"),
+}
+ETIQUETAS_MATERIALIDAD = [("benchmark", "Benchmark"), ("benchmark_value", "Valor base"), ("p_general", "% Mat. General"),
+                          ("mat_general", "Mat. General"), ("p_performance", "% Performance"), ("mat_performance", "Mat. Performance"),
+                          ("p_ranr", "% RANR"), ("mat_ranr", "Umbral RANR")]
+COLUMNAS_PROGRAMA = ["Sección", "Área", "Código", "Descripción", "Instrucciones", "Notas", "Estado", "Evidencias"]
+HORAS_RETENCION_EXPORTACION = 24
+
+def _materialidad_expediente(conn, client_id):
+    cur = conn.execute("SELECT * FROM materiality WHERE client_id=?", (client_id,))
+    fila = cur.fetchone()
+    if not fila: return []
+    valores = dict(zip([c[0] for c in cur.description], fila))
+    return [(etiqueta, valores[col]) for col, etiqueta in ETIQUETAS_MATERIALIDAD]
+
+def iterar_expediente(conn, client_id):
+    """Pasos del cliente en orden del programa con sus evidencias e historial completo, uno a la vez."""
+    cur = conn.execute("""SELECT id, section_name, area_name, step_code, description, instructions, user_notes, status
+        FROM audit_steps WHERE client_id=? AND is_deleted=0 ORDER BY section_name, area_name, step_code, id""", (client_id,))
+    for paso in cur:
+        evidencias = [n for (n,) in conn.execute("SELECT file_name FROM audit_evidence WHERE step_id=? ORDER BY id", (paso[0],))]
+        yield paso, evidencias, leer_historial(paso[0], client_id=client_id)
+
+def _escribir_xlsx(ruta, cliente, materialidad, pasos):
+    import xlsxwriter
+    # constant_memory: cada hoja se vuelca fila a fila a disco (hay que escribir en orden)
+    wb = xlsxwriter.Workbook(ruta, {'constant_memory': True, 'tmpdir': EXPORT_DIR})
+    negrita = wb.add_format({'bold': True, 'bg_color': '#1e3a8a', 'font_color': 'white'})
+    hoja, bitacora, mat = wb.add_worksheet("Programa"), wb.add_worksheet("Bitácora"), wb.add_worksheet("Materialidad")
+    hoja.write_row(0, 0, COLUMNAS_PROGRAMA, negrita)
+    bitacora.write_row(0, 0, ["Código", "Fecha", "Usuario", "Acción"], negrita)
+    mat.write_row(0, 0, [cliente[0], f"NIT: {cliente[1]}"], negrita)
+    for i, (etiqueta, valor) in enumerate(materialidad, 1): mat.write_row(i, 0, [etiqueta, valor])
+    fila_log = 1
+    for fila, (paso, evidencias, historial) in enumerate(pasos, 1):
+        hoja.write_row(fila, 0, list(paso[1:]) + [", ".join(evidencias)])
+        for fecha, usuario, accion in historial:
+            bitacora.write_row(fila_log, 0, [paso[3], fecha, usuario, accion]); fila_log += 1
+    wb.close()
+
+def _texto_pdf(texto):
+    # Las fuentes base del PDF son latin-1; lo que no cabe (emojis) se reemplaza
+    return str(texto or "").encode("latin-1", "replace").decode("latin-1")
+
+def _escribir_pdf(ruta, cliente, materialidad, pasos):
+    from fpdf import FPDF
+    pdf = FPDF(); pdf.set_auto_page_break(True, margin=15); pdf.add_page()
+    pdf.set_font("Helvetica", "B", 16); pdf.multi_cell(0, 9, _texto_pdf(f"Expediente de auditoría: {cliente[0]}"), new_x="LMARGIN", new_y="NEXT")
+    pdf.set_font("Helvetica", "", 10); pdf.multi_cell(0, 6, _texto_pdf(f"NIT: {cliente[1]}"), new_x="LMARGIN", new_y="NEXT")
+    if materialidad:
+        pdf.set_font("Helvetica", "B", 12); pdf.cell(0, 9, "Materialidad (NIA 320)", new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("Helvetica", "", 10)
+        for etiqueta, valor in materialidad:
+            pdf.cell(0, 6, _texto_pdf(f"{etiqueta}: {valor:,.2f}" if isinstance(valor, float) else f"{etiqueta}: {valor}"), new_x="LMARGIN", new_y="NEXT")
+    area_actual = None
+    for paso, evidencias, historial in pasos:
+        if (paso[1], paso[2]) != area_actual:
+            area_actual = (paso[1], paso[2])
+            pdf.set_font("Helvetica", "B", 12); pdf.multi_cell(0, 9, _texto_pdf(f"{paso[1]} / {paso[2]}"), new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("Helvetica", "B", 10); pdf.multi_cell(0, 6, _texto_pdf(f"[{paso[3]}] {paso[4]} ({paso[7]})"), new_x="LMARGIN", new_y="NEXT")
+        pdf.set_font("Helvetica", "", 9)
+        for etiqueta, valor in (("Instrucciones", paso[5]), ("Notas", paso[6]), ("Evidencias", ", ".join(evidencias))):
+            if valor: pdf.multi_cell(0, 5, _texto_pdf(f"{etiqueta}: {valor}"), new_x="LMARGIN", new_y="NEXT")
+        for fecha, usuario, accion in historial:
+            pdf.multi_cell(0, 5, _texto_pdf(f"  {fecha} - {usuario}: {accion}"), new_x="LMARGIN", new_y="NEXT")
+    pdf.output(ruta)
+
+def _escribir_docx(ruta, cliente, materialidad, pasos):
+    import docx
+    doc = docx.Document()
+    doc.add_heading(f"Expediente de auditoría: {cliente[0]}", 0)
+    doc.add_paragraph(f"NIT: {cliente[1]}")
+    if materialidad:
+        doc.add_heading("Materialidad (NIA 320)", 1)
+        tabla = doc.add_table(rows=0, cols=2)
+        for etiqueta, valor in materialidad:
+            celdas = tabla.add_row().cells
+            celdas[0].text, celdas[1].text = etiqueta, f"{valor:,.2f}" if isinstance(valor, float) else str(valor)
+    area_actual = None
+    for paso, evidencias, historial in pasos:
+        if (paso[1], paso[2]) != area_actual:
+            area_actual = (paso[1], paso[2]); doc.add_heading(f"{paso[1]} / {paso[2]}", 1)
+        doc.add_heading(f"[{paso[3]}] {paso[4]} ({paso[7]})", 2)
+        for etiqueta, valor in (("Instrucciones", paso[5]), ("Notas", paso[6]), ("Evidencias", ", ".join(evidencias))):
+            if not valor: continue
+            parrafo = doc.add_paragraph()
+            parrafo.add_run(f"{etiqueta}: ").bold = True; parrafo.add_run(str(valor))
+        for fecha, usuario, accion in historial:
+            doc.add_paragraph(f"{fecha} - {usuario}: {accion}", style="List Bullet")
+    doc.save(ruta)
+
+ESCRITORES_EXPEDIENTE = {'xlsx': _escribir_xlsx, 'pdf': _escribir_pdf, 'docx': _escribir_docx}
+
+def exportar_evidencias_zip(conn, client_id, ruta, al_progresar=None):
+    """ZIP de evidencias por sección/área; cada archivo se copia en bloques desde el almacén."""
+    import zipfile
+    total = conn.execute("""SELECT COUNT(*) FROM audit_evidence e JOIN audit_steps s ON s.id = e.step_id
+        WHERE s.client_id=? AND s.is_deleted=0""", (client_id,)).fetchone()[0]
+    cur = conn.execute("""SELECT e.id, e.file_name, e.file_hash, s.section_name, s.area_name, s.step_code
+        FROM audit_evidence e JOIN audit_steps s ON s.id = e.step_id
+        WHERE s.client_id=? AND s.is_deleted=0 ORDER BY s.section_name, s.area_name, s.step_code, e.id""", (client_id,))
+    with zipfile.ZipFile(ruta, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        faltantes = []
+        for i, (ev_id, nombre, file_hash, seccion, area, codigo) in enumerate(cur, 1):
+            destino = "/".join(re.sub(r'[\\/:*?"<>|]', "_", str(p or "")) for p in (seccion, area, f"{codigo}_{ev_id}_{nombre}"))
+            origen = ruta_evidencia(file_hash)
+            if os.path.exists(origen): zf.write(origen, destino)
+            else: faltantes.append(destino)
+            if al_progresar: al_progresar(i / total, f"{i:,} de {total:,} evidencias")
+        if faltantes: zf.writestr("FALTANTES.txt", "\n".join(faltantes))
+
+def exportar_expediente(client_id, formato, ruta, al_progresar=None):
+    """Escribe el expediente del cliente en `ruta` leyendo paso a paso (nunca todo el programa en memoria)."""
+    parcial = f"{ruta}.parcial"
+    with conexion() as conn:
+        cliente = conn.execute("SELECT client_name, client_nit FROM clients WHERE id=?", (client_id,)).fetchone()
+    with conexion(client_id) as conn:
+        if formato == 'zip':
+            exportar_evidencias_zip(conn, client_id, parcial, al_progresar)
+        else:
+            total = conn.execute("SELECT COUNT(*) FROM audit_steps WHERE client_id=? AND is_deleted=0", (client_id,)).fetchone()[0]
+            def pasos():
+                for i, fila in enumerate(iterar_expediente(conn, client_id), 1):
+                    yield fila
+                    if al_progresar and (i % 25 == 0 or i == total): al_progresar(i / total, f"{i:,} de {total:,} pasos")
+            ESCRITORES_EXPEDIENTE[formato](parcial, cliente, _materialidad_expediente(conn, client_id), pasos())
+    os.replace(parcial, ruta)
+
+class MotorExportacion:
+    """Cola de exportaciones en hilos de fondo; la sesión de Streamlit solo consulta el avance."""
+
+    def __init__(self, max_hilos=2):
+        import concurrent.futures
+        self._ejecutor = concurrent.futures.ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix="exportacion")
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self._contador = itertools.count(1)
+
+    def enviar(self, client_id, formato):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        self._limpiar_antiguas()
+        trabajo_id = next(self._contador)
+        marca = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        trabajo = {'id': trabajo_id, 'client_id': client_id, 'formato': formato, 'estado': 'En cola', 'avance': 0.0,
+                   'mensaje': "Esperando turno...", 'archivo': f"expediente_{client_id}_{marca}_{trabajo_id}.{formato}", 'error': None}
+        trabajo['ruta'] = os.path.join(EXPORT_DIR, trabajo['archivo'])
+        with self._lock: self._trabajos[trabajo_id] = trabajo
+        self._ejecutor.submit(self._ejecutar, trabajo)
+        return trabajo_id
+
+    def _ejecutar(self, trabajo):
+        def al_progresar(avance, mensaje): trabajo.update(avance=avance, mensaje=mensaje)
+        trabajo['estado'] = 'En proceso'
+        try:
+            exportar_expediente(trabajo['client_id'], trabajo['formato'], trabajo['ruta'], al_progresar)
+            trabajo.update(estado='Listo', avance=1.0, mensaje="Exportación finalizada.")
+        except Exception as e:
+            trabajo.update(estado='Error', error=str(e), mensaje=f"Error: {e}")
+
+    def obtener(self, trabajo_id):
+        return dict(self._trabajos.get(trabajo_id) or {})
+
+    def _limpiar_antiguas(self):
+        limite = datetime.datetime.now().timestamp() - HORAS_RETENCION_EXPORTACION * 3600
+        with self._lock:
+            for trabajo_id, t in list(self._trabajos.items()):
+                if t['estado'] in ('Listo', 'Error') and os.path.exists(t['ruta']) and os.path.getmtime(t['ruta']) < limite:
+                    os.remove(t['ruta']); del self._trabajos[trabajo_id]
+
+@st.cache_resource
+def obtener_motor_exportacion():
+    return MotorExportacion()
+
+# --- LECTURAS CACHEADAS ---
+def leer_clientes():
+    def cargar():
+        with conexion() as conn:
+            return pd.read_sql_query("SELECT * FROM clients WHERE is_deleted=0", conn)
+    return obtener_cache().obtener(CACHE_CLIENTES, 'clientes', (), cargar)
+
+def leer_materialidad(client_id):
+    def cargar():
+        with conexion(client_id) as conn:
+            return conn.execute("SELECT * FROM materiality WHERE client_id=?", (client_id,)).fetchone()
+    return obtener_cache().obtener(client_id, 'materialidad', (), cargar)
+
+def leer_secciones_areas(client_id):
+    def cargar():
+        with conexion(client_id) as conn:
+            return listar_secciones_areas(conn, client_id)
+    return obtener_cache().obtener(client_id, 'secciones_areas', (), cargar)
+
+def leer_pagina_programa(client_id, despues, filtros):
+    """Conteos por área y página del programa; ver cargar_programa_trabajo."""
+    def cargar():
+        with conexion(client_id) as conn:
+            return (contar_pasos_por_area(conn, client_id, **filtros),) + cargar_programa_trabajo(conn, client_id, despues=despues, **filtros)
+    return obtener_cache().obtener(client_id, 'pagina', (despues, tuple(sorted(filtros.items()))), cargar)
 
 # --- MÓDULOS ---
+@instrumentar
 def modulo_materialidad(client_id):
     st.markdown("### 📊 Materialidad (NIA 320)")
-    conn = get_db_connection()
-    datos = conn.execute("SELECT * FROM materiality WHERE client_id=?", (client_id,)).fetchone()
-    conn.close()
+    datos = leer_materialidad(client_id)
     with st.container(border=True):
         c1, c2, c3 = st.columns(3)
         with c1:
-            options = ["Utilidad Neta", "Ingresos Totales", "Activos Totales", "EBITDA"]
+            options = list(RANGOS_BENCHMARK)
             idx = options.index(datos[1]) if datos and datos[1] in options else 0
             benchmark = st.selectbox("Benchmark", options, index=idx)
             valor_base = st.number_input("Valor Base ($)", min_value=0.0, value=datos[2] if datos else 0.0)
         with c2:
-            max_p = 10.0 if benchmark == "Utilidad Neta" else 5.0
-            p_gen = st.slider("% Mat. General", 0.0, max_p, datos[3] if datos else max_p/2)
-            p_perf = st.slider("% Performance", 0.0, 75.0, datos[5] if datos else 50.0)
+            min_p, max_p, sugerido = RANGOS_BENCHMARK[benchmark]
+            p_gen = st.slider("% Mat. General", min_p, max_p, datos[3] if datos else sugerido)
+            p_perf = st.slider("% Performance", *RANGO_PERFORMANCE[:2], datos[5] if datos else RANGO_PERFORMANCE[2])
         with c3:
-            p_ranr = st.slider("% RANR", 0.0, 10.0, datos[7] if datos else 5.0)
+            p_ranr = st.slider("% RANR", *RANGO_RANR[:2], datos[7] if datos else RANGO_RANR[2])
         
         m_gen = valor_base * (p_gen / 100)
         m_perf = m_gen * (p_perf / 100)
@@ -206,39 +1526,97 @@ def modulo_materialidad(client_id):
     
     # Botón descriptivo
     if st.button("💾 Guardar Cálculo de Materialidad", use_container_width=True):
-        conn = get_db_connection()
-        conn.execute("INSERT OR REPLACE INTO materiality VALUES (?,?,?,?,?,?,?,?,?)", 
-                     (client_id, benchmark, valor_base, p_gen, m_gen, p_perf, m_perf, p_ranr, m_ranr))
-        conn.commit(); conn.close()
+        with transaccion(client_id) as conn:
+            conn.execute("INSERT OR REPLACE INTO materiality VALUES (?,?,?,?,?,?,?,?,?)", 
+                         (client_id, benchmark, valor_base, p_gen, m_gen, p_perf, m_perf, p_ranr, m_ranr))
+        invalidar_cliente(client_id)
         st.success("Configuración de materialidad guardada correctamente.")
 
+def _registrar_pendiente(pendientes, sid, original):
+    # Callback de los widgets en modo lote: guarda la edición solo si difiere de lo leído
+    edicion = {'notas': st.session_state[f"nt_{sid}"], 'estado': st.session_state[f"es_{sid}"], 'version': original['version']}
+    if edicion['notas'].strip() == original['notas'].strip() and edicion['estado'] == original['estado']: pendientes.pop(sid, None)
+    else: pendientes[sid] = edicion
+
+def _descartar_pendientes(pendientes):
+    for sid in pendientes:
+        st.session_state.pop(f"nt_{sid}", None); st.session_state.pop(f"es_{sid}", None)
+    pendientes.clear()
+
+def _leer_pagina_no_vacia(client_id, pag, filtros):
+    # Si los pasos de una página posterior dejaron de cumplir el filtro (p. ej. se terminaron), se retrocede
+    pagina = leer_pagina_programa(client_id, pag['pila'][-1], filtros)
+    while pagina[1].empty and len(pag['pila']) > 1:
+        pag['pila'].pop(); pagina = leer_pagina_programa(client_id, pag['pila'][-1], filtros)
+    return pagina
+
+@instrumentar
 def modulo_programa_trabajo(client_id):
     st.markdown("### 📝 Programa de Trabajo")
-    conn = get_db_connection()
-    steps = pd.read_sql_query("SELECT * FROM audit_steps WHERE client_id=? AND is_deleted=0 ORDER BY section_name ASC, area_name ASC, step_code ASC", conn, params=(client_id,))
     opciones_estado = ["Sin Iniciar", "En Proceso", "Terminado"]
+    secciones_areas = leer_secciones_areas(client_id)
 
-    if steps.empty:
+    if not secciones_areas:
         st.info("No hay pasos. Use el módulo de importación.")
-        conn.close(); return
+        return
 
-    c_f1, c_f2 = st.columns([2, 1])
+    c_f1, c_f2, c_f3, c_f4 = st.columns([2, 1, 1, 1])
     search = c_f1.text_input("🔍 Buscar Procedimiento:", "")
-    seccion_f = c_f2.selectbox("📁 Filtrar Sección:", ["Todas"] + sorted(list(steps['section_name'].unique())))
+    seccion_f = c_f2.selectbox("📁 Filtrar Sección:", ["Todas"] + sorted({sec for sec, _ in secciones_areas}))
+    area_f = c_f3.selectbox("📍 Filtrar Área:", ["Todas"] + sorted({a for sec, a in secciones_areas if seccion_f in ("Todas", sec)}))
+    estado_f = c_f4.selectbox("🚦 Filtrar Estado:", ["Todos"] + opciones_estado)
+    filtros = {'seccion': None if seccion_f == "Todas" else seccion_f, 'area': None if area_f == "Todas" else area_f,
+               'estado': None if estado_f == "Todos" else estado_f, 'texto': search}
+
+    # Pila de claves de paginación; se reinicia cuando cambian los filtros
+    pag = st.session_state.setdefault(f"pag_{client_id}", {'filtros': None, 'pila': [None]})
+    if pag['filtros'] != filtros: pag['filtros'], pag['pila'] = dict(filtros), [None]
 
-    df_f = steps.copy()
-    if search: df_f = df_f[df_f['description'].str.contains(search, case=False) | df_f['step_code'].str.contains(search, case=False)]
-    if seccion_f != "Todas": df_f = df_f[df_f['section_name'] == seccion_f]
+    conteos, steps, hay_mas, evidencias, logs = _leer_pagina_no_vacia(client_id, pag, filtros)
+    total = sum(conteos.values())
+    if steps.empty:
+        st.info("Ningún procedimiento coincide con los filtros seleccionados.")
+        return
+
+    # Edición por lotes: los cambios quedan pendientes y se guardan juntos en una transacción
+    modo_lote = st.toggle("✏️ Edición por lotes (guardar varios pasos a la vez)", key=f"lote_{client_id}")
+    pendientes = st.session_state.setdefault(f"pendientes_{client_id}", {})
+    if modo_lote and pendientes:
+        c_g, c_d = st.columns([3, 1])
+        if c_g.button(f"💾 Guardar todos los cambios ({len(pendientes)})", type="primary", use_container_width=True):
+            guardados, conflictos = guardar_cambios_lote({sid: (p['notas'], p['estado'], p['version']) for sid, p in pendientes.items()},
+                                                         st.session_state.user_id, st.session_state.user_name, client_id)
+            _descartar_pendientes(pendientes)
+            if guardados: st.success(f"Se registraron {len(guardados)} pasos en una sola operación.")
+            if conflictos: st.warning(f"{len(conflictos)} pasos fueron modificados por otro auditor mientras editaba; se recargaron sus valores actuales.")
+            conteos, steps, hay_mas, evidencias, logs = _leer_pagina_no_vacia(client_id, pag, filtros)
+            total = sum(conteos.values())
+            if steps.empty: st.info("Ningún procedimiento coincide con los filtros seleccionados."); return
+        elif c_d.button("Descartar", use_container_width=True):
+            _descartar_pendientes(pendientes); st.rerun()
 
-    for area in df_f['area_name'].unique():
-        st.markdown(f'<div class="area-header">📍 Área: {area}</div>', unsafe_allow_html=True)
+    inicio = (len(pag['pila']) - 1) * TAM_PAGINA
+    c_ant, c_info, c_sig = st.columns([1, 3, 1])
+    if c_ant.button("⬅️ Anterior", disabled=len(pag['pila']) == 1, use_container_width=True):
+        pag['pila'].pop(); st.rerun()
+    c_info.caption(f"Mostrando {inicio + 1}–{inicio + len(steps)} de {total} procedimientos (página {len(pag['pila'])})")
+    if c_sig.button("Siguiente ➡️", disabled=not hay_mas, use_container_width=True):
+        u = steps.iloc[-1]
+        pag['pila'].append((u['section_name'], u['area_name'], u['step_code'], int(u['id']))); st.rerun()
+
+    for (seccion, area), subset in steps.groupby(['section_name', 'area_name'], sort=False):
+        st.markdown(f'<div class="area-header">📍 Área: {area} · {conteos.get((seccion, area), len(subset))} procedimientos</div>', unsafe_allow_html=True)
         with st.expander(f"Ver procedimientos de {area}", expanded=True):
-            subset = df_f[df_f['area_name'] == area]
             for _, row in subset.iterrows():
-                sid = row['id']
+                sid = int(row['id'])
                 icon = "⚪" if row['status'] == "Sin Iniciar" else "🟡" if row['status'] == "En Proceso" else "🟢"
+                evs = evidencias.get(sid, [])
+                clip = f" · 📎 {len(evs)}" if evs else ""
                 
-                with st.expander(f"{icon} [{row['step_code']}] - {row['description'][:90]}..."):
+                # El contenido del paso solo se construye cuando el expander está abierto
+                exp = st.expander(f"{icon} [{row['step_code']}] - {row['description'][:90]}...{clip}", key=f"exp_{sid}", on_change="rerun")
+                with exp:
+                    if not exp.open: continue
                     st.markdown(f"**Procedimiento:** {row['description']}")
                     st.markdown(f'<div class="guia-box"><strong>Guía Técnica:</strong><br>{row["instructions"]}</div>', unsafe_allow_html=True)
                     
@@ -246,14 +1624,20 @@ def modulo_programa_trabajo(client_id):
                     
                     # TAB 1: NOTAS
                     with tabs[0]:
-                        n_nota = st.text_area("Conclusiones del Auditor:", value=row['user_notes'] or "", key=f"nt_{sid}")
+                        original = {'notas': row['user_notes'] or "", 'estado': row['status'] if row['status'] in opciones_estado else "Sin Iniciar", 'version': int(row['version'])}
+                        actual = pendientes.get(sid, original) if modo_lote else original
+                        cb = {'on_change': _registrar_pendiente, 'args': (pendientes, sid, original)} if modo_lote else {}
+                        n_nota = st.text_area("Conclusiones del Auditor:", value=actual['notas'], key=f"nt_{sid}", **cb)
                         c_e, c_b = st.columns([1, 1])
-                        n_est = c_e.selectbox("Estado del Procedimiento", opciones_estado, index=opciones_estado.index(row['status'] if row['status'] in opciones_estado else "Sin Iniciar"), key=f"es_{sid}")
+                        n_est = c_e.selectbox("Estado del Procedimiento", opciones_estado, index=opciones_estado.index(actual['estado']), key=f"es_{sid}", **cb)
                         
+                        if modo_lote:
+                            if sid in pendientes: c_b.caption("✏️ Cambio pendiente de guardar")
                         # Botón Descriptivo
-                        if c_b.button("💾 Registrar Avance y Notas", key=f"btn_{sid}", use_container_width=True):
-                            if actualizar_paso_seguro(sid, st.session_state.user_id, st.session_state.user_name, n_nota, n_est):
-                                st.success("Avance registrado exitosamente."); st.rerun()
+                        elif c_b.button("💾 Registrar Avance y Notas", key=f"btn_{sid}", use_container_width=True):
+                            guardados, conflictos = guardar_cambios_lote({sid: (n_nota, n_est, original['version'])}, st.session_state.user_id, st.session_state.user_name, client_id)
+                            if guardados: st.success("Avance registrado exitosamente."); st.rerun()
+                            elif conflictos: st.warning("Otro auditor modificó este paso mientras usted editaba. Recargue para ver la versión actual.")
                             else: st.info("No se detectaron cambios nuevos para guardar.")
                     
                     # TAB 2: EVIDENCIAS
@@ -261,24 +1645,20 @@ def modulo_programa_trabajo(client_id):
                         uploaded = st.file_uploader("Seleccionar archivo de soporte", key=f"up_{sid}")
                         # Botón Descriptivo
                         if uploaded and st.button("☁️ Cargar Evidencia al Servidor", key=f"upl_{sid}"):
-                            if guardar_evidencia(sid, st.session_state.user_id, uploaded):
+                            if guardar_evidencia(sid, st.session_state.user_id, uploaded, client_id):
                                 st.success("Archivo subido y encriptado correctamente."); st.rerun()
                         
                         st.divider()
-                        conn_ev = get_db_connection()
-                        evs = pd.read_sql_query("SELECT id, file_name, file_type, file_data, upload_date FROM audit_evidence WHERE step_id=?", conn_ev, params=(sid,))
-                        conn_ev.close()
-                        
-                        if not evs.empty:
+                        if evs:
                             st.write("**Archivos Adjuntos:**")
-                            for _, ev in evs.iterrows():
+                            for ev in evs:
                                 c_info, c_down, c_del = st.columns([3, 1.2, 0.8])
-                                c_info.write(f"📄 {ev['file_name']}")
+                                c_info.write(f"📄 {ev['file_name']} ({(ev['file_size'] or 0) / 1024:,.1f} KB)")
                                 
-                                # Botón Descarga
+                                # Botón Descarga: el archivo se lee del disco solo al hacer clic
                                 c_down.download_button(
                                     label="⬇️ Descargar", 
-                                    data=ev['file_data'], 
+                                    data=lambda h=ev['file_hash']: leer_evidencia(h), 
                                     file_name=ev['file_name'], 
                                     mime=ev['file_type'], 
                                     key=f"dl_{ev['id']}"
@@ -289,19 +1669,21 @@ def modulo_programa_trabajo(client_id):
                                     st.markdown("⚠️ **¿Estás seguro?**")
                                     st.caption("Esta acción no se puede deshacer.")
                                     if st.button("Sí, Eliminar", key=f"confirm_del_{ev['id']}", type="primary"):
-                                        eliminar_evidencia(ev['id'])
-                                        st.rerun()
+                                        if eliminar_evidencia(ev['id'], client_id): st.rerun()
                         else: st.caption("No hay evidencias adjuntas para este paso.")
 
                     # TAB 3: HISTORIAL
                     with tabs[2]:
-                        conn_log = get_db_connection()
-                        logs = pd.read_sql_query("SELECT timestamp, user_name, action FROM audit_logs WHERE step_id=? ORDER BY timestamp DESC", conn_log, params=(sid,))
-                        conn_log.close()
-                        if not logs.empty: st.dataframe(logs, hide_index=True, use_container_width=True)
+                        # Los registros antiguos pueden estar en el archivo segmentado; se completan desde allí
+                        completo = st.checkbox("Ver historial completo", key=f"hc_{sid}")
+                        hist = logs.get(sid, [])
+                        if completo or len(hist) < LOGS_RECIENTES: hist = leer_historial(sid, None if completo else LOGS_RECIENTES, client_id)
+                        if hist:
+                            st.dataframe(pd.DataFrame(hist, columns=["timestamp", "user_name", "action"]), hide_index=True, use_container_width=True)
+                            if not completo and len(hist) == LOGS_RECIENTES: st.caption(f"Se muestran los últimos {LOGS_RECIENTES} cambios.")
                         else: st.write("No hay historial de modificaciones.")
-    conn.close()
 
+@instrumentar
 def modulo_importacion(client_id):
     st.markdown("### 📥 Importación Masiva")
     st.markdown("#### 1. Descargar Formato")
@@ -312,51 +1694,162 @@ def modulo_importacion(client_id):
     st.markdown("#### 2. Carga de Datos")
     up = st.file_uploader("Seleccione su archivo Excel o CSV", type=['xlsx', 'csv'])
     if up and st.button("🚀 Procesar e Importar Datos", use_container_width=True):
+        barra = st.progress(0.0, text="Leyendo archivo...")
+        def al_progresar(avance, filas):
+            barra.progress(avance if avance is not None else 0.0, text=f"Procesadas {filas:,} filas...")
         try:
-            df = pd.read_csv(up) if up.name.endswith('.csv') else pd.read_excel(up)
-            conn = get_db_connection(); cursor = conn.cursor()
-            existentes = pd.read_sql_query("SELECT step_code FROM audit_steps WHERE client_id=?", conn, params=(client_id,))
-            set_ex = set(existentes['step_code'].astype(str))
-            
-            nuevos = 0
-            for _, r in df.iterrows():
-                if str(r['Codigo']) not in set_ex:
-                    cursor.execute("INSERT INTO audit_steps (client_id, section_name, area_name, step_code, description, instructions) VALUES (?,?,?,?,?,?)", 
-                                   (client_id, r['Seccion'], r['Area'], r['Codigo'], r['Descripcion'], r['Instrucciones']))
-                    nuevos += 1
-            conn.commit(); conn.close()
-            st.success(f"Proceso completado: Se importaron {nuevos} nuevos procedimientos.")
+            resumen = importar_procedimientos(client_id, up, up.name, al_progresar)
+            barra.progress(1.0, text="Importación finalizada.")
+            st.success(f"Proceso completado: Se importaron {resumen['insertados']} nuevos procedimientos.")
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Insertados", f"{resumen['insertados']:,}")
+            c2.metric("Duplicados omitidos", f"{resumen['duplicados']:,}")
+            c3.metric("Rechazados", f"{len(resumen['rechazados']):,}")
+            if resumen['rechazados']:
+                st.warning("Filas rechazadas (no se importaron):")
+                st.dataframe(pd.DataFrame(resumen['rechazados'], columns=["Fila", "Motivo"]), hide_index=True, use_container_width=True)
         except Exception as e: st.error(f"Error en el archivo: {e}")
 
+def leer_archivo(ruta):
+    with open(ruta, 'rb') as f: return f.read()
+
+def _lista_exportaciones(motor, trabajos):
+    for trabajo_id in trabajos:
+        t = motor.obtener(trabajo_id)
+        if not t: continue
+        with st.container(border=True):
+            st.write(f"**{FORMATOS_EXPORTACION[t['formato']][0]}** · {t['archivo']}")
+            if t['estado'] == 'Listo':
+                st.download_button("⬇️ Descargar", data=lambda ruta=t['ruta']: leer_archivo(ruta), file_name=t['archivo'],
+                                   mime=FORMATOS_EXPORTACION[t['formato']][1], key=f"dl_exp_{trabajo_id}", use_container_width=True)
+            elif t['estado'] == 'Error': st.error(t['mensaje'])
+            else: st.progress(t['avance'], text=f"{t['estado']}: {t['mensaje']}")
+
+@instrumentar
+def modulo_exportacion(client_id):
+    st.markdown("### 📦 Exportar Expediente")
+    st.caption("La exportación se genera en segundo plano: puede seguir trabajando y volver aquí para descargarla.")
+    motor = obtener_motor_exportacion()
+    trabajos = st.session_state.setdefault(f"exportaciones_{client_id}", [])
+    formato = st.selectbox("Formato", list(FORMATOS_EXPORTACION), format_func=lambda f: FORMATOS_EXPORTACION[f][0])
+    if st.button("🚀 Generar Exportación", use_container_width=True):
+        trabajos.insert(0, motor.enviar(client_id, formato))
+    # Mientras haya trabajos pendientes solo se refresca este bloque, no toda la página
+    pendientes = any(motor.obtener(t).get('estado') in ('En cola', 'En proceso') for t in trabajos)
+    st.fragment(_lista_exportaciones, run_every=1 if pendientes else None)(motor, trabajos)
+
+@instrumentar
+def panel_cartera_materialidad():
+    cartera = cargar_cartera_materialidad()
+    if not len(cartera['client_id']):
+        st.caption("Ningún cliente tiene materialidad guardada."); return
+    motivos = validar_umbrales(cartera)
+    alertas = [(n, b, "; ".join(m)) for n, b, m in zip(cartera['client_name'], cartera['benchmark'], motivos) if m]
+    c1, c2 = st.columns(2)
+    c1.metric("Clientes con materialidad", f"{len(motivos):,}")
+    c2.metric("Clientes con alertas", f"{len(alertas):,}")
+    if alertas:
+        st.warning("Umbrales fuera de los rangos admitidos:")
+        st.dataframe(pd.DataFrame(alertas, columns=["Cliente", "Benchmark", "Motivo"]), hide_index=True, use_container_width=True)
+    st.markdown("**Análisis de sensibilidad**")
+    c1, c2, c3 = st.columns(3)
+    pasos = (c1.slider("Pasos % general", 2, 41, 11), c2.slider("Pasos % performance", 2, 41, 11), c3.slider("Pasos % RANR", 2, 41, 11))
+    inicio = datetime.datetime.now()
+    resumen = resumen_sensibilidad(cartera, *pasos)
+    st.caption(f"{np.prod(pasos):,} escenarios × {len(resumen):,} clientes en {(datetime.datetime.now() - inicio).total_seconds() * 1000:,.0f} ms")
+    st.dataframe(resumen, hide_index=True, use_container_width=True, column_config={c: st.column_config.NumberColumn(format="dollar") for c in resumen.columns[2:]})
+
+def panel_diagnostico():
+    st.subheader("Diagnóstico")
+    with st.expander("🩺 Rendimiento de consultas y módulos"):
+        if not INSTRUMENTACION:
+            st.caption("Instrumentación apagada. Inicie la app con AUDITPRO_DIAGNOSTICO=1 para medir consultas y módulos.")
+        else:
+            metricas = obtener_metricas()
+            metricas.umbral_ms = st.number_input("Umbral de consulta lenta (ms)", min_value=1.0, value=float(metricas.umbral_ms), step=10.0)
+            latencia = metricas.latencia_reruns()
+            if latencia:
+                c1, c2 = st.columns(2)
+                c1.metric("Reejecución p50", f"{latencia['p50_ms']:,.0f} ms")
+                c2.metric("Reejecución p95", f"{latencia['p95_ms']:,.0f} ms")
+            st.markdown("**Módulos** (resto = pandas y construcción de widgets)")
+            st.dataframe(metricas.resumen_modulos(), hide_index=True, use_container_width=True)
+            st.markdown("**Consultas con más tiempo acumulado**")
+            st.dataframe(metricas.top_consultas(), hide_index=True, use_container_width=True)
+            if metricas.lentas:
+                st.markdown("**Consultas lentas**")
+                st.dataframe(pd.DataFrame(list(metricas.lentas), columns=["Fecha", "ms", "Filas", "SQL"]), hide_index=True, use_container_width=True)
+            st.download_button("⬇️ Exportar JSON", data=lambda: json.dumps(metricas.exportar(), ensure_ascii=False, indent=2, default=str),
+                               file_name="diagnostico_auditpro.json", mime="application/json", use_container_width=True)
+            if st.button("Reiniciar métricas", use_container_width=True): metricas.reiniciar(); st.rerun()
+        if st.button("Verificar planes de consulta", use_container_width=True):
+            # En modo shards los índices viven en las bases de cliente
+            with conexion(next(iter(clientes_con_base()), None) if MODO_SHARDS else None) as conn:
+                for nombre, (usa_indice, detalle) in verificar_planes_consulta(conn).items():
+                    (st.success if usa_indice else st.error)(f"{nombre}: {' / '.join(detalle)}")
+
+def panel_archivo_logs():
+    st.subheader("Archivo de Bitácora")
+    with st.expander("🗄️ Archivar y verificar audit_logs"):
+        corte = st.date_input("Archivar registros anteriores a:", datetime.date.today() - datetime.timedelta(days=365))
+        eliminados = st.checkbox("Incluir clientes eliminados", value=True)
+        if st.button("Archivar registros", use_container_width=True):
+            n = archivar_logs(antes_de=corte.isoformat(), incluir_eliminados=eliminados)
+            st.success(f"Se archivaron {n:,} registros.") if n else st.info("No hay registros que archivar.")
+        if st.button("Reconciliar resumen de avance", use_container_width=True):
+            n = 0
+            for cid in bases_de_clientes():
+                with transaccion(cid) as conn: n += reconstruir_resumen_progreso(conn)
+            st.success(f"Resumen reconstruido; {n} áreas tenían contadores desfasados.")
+        if st.button("Verificar integridad", use_container_width=True):
+            resultado = [(seg_id if cid is None else f"{cid}/{seg_id}", ok, detalle)
+                         for cid in bases_de_clientes() for seg_id, ok, detalle in verificar_archivo_logs(cid)]
+            if not resultado: st.caption("Aún no hay segmentos archivados.")
+            for seg_id, ok, detalle in resultado:
+                (st.success if ok else st.error)(f"Segmento {seg_id}: {detalle}")
+
 # --- VISTAS PRINCIPALES ---
+@instrumentar
 def vista_principal():
     is_admin = "Administrador" in st.session_state.get('user_role', "Miembro")
     with st.sidebar:
         st.markdown(f"### 👤 {st.session_state.user_name}")
         st.markdown(f"<span class='admin-badge'>{st.session_state.user_role}</span>", unsafe_allow_html=True)
         if st.button("🔒 Cerrar Sesión Segura"): st.session_state.clear(); st.rerun()
+        if is_admin:
+            est = obtener_cache().estadisticas()
+            st.caption(f"Caché: {est['aciertos']} aciertos · {est['fallos']} fallos · {est['entradas']} entradas")
         st.divider()
         st.subheader("Alta de Clientes")
         n_name = st.text_input("Razón Social / Empresa")
         n_nit = st.text_input("NIT / Identificación")
         if st.button("✅ Registrar Nuevo Cliente") and n_name:
-            conn = get_db_connection(); cur = conn.cursor()
-            cur.execute("INSERT INTO clients (user_id, client_name, client_nit) VALUES (?,?,?)", (st.session_state.user_id, n_name, n_nit))
-            lid = cur.lastrowid
-            cargar_pasos_iniciales(conn, lid)
-            conn.commit(); conn.close(); st.rerun()
+            with transaccion() as conn:
+                cur = conn.cursor()
+                cur.execute("INSERT INTO clients (user_id, client_name, client_nit) VALUES (?,?,?)", (st.session_state.user_id, n_name, n_nit))
+                lid = cur.lastrowid
+                # Monolítica: misma conexión, una sola transacción. Shards: crea el archivo del cliente
+                with transaccion(lid) as conn_cliente: cargar_pasos_iniciales(conn_cliente, lid)
+            invalidar_cliente(CACHE_CLIENTES, lid)
+            st.rerun()
+        if is_admin:
+            st.divider()
+            panel_archivo_logs()
+            panel_diagnostico()
 
     if 'active_id' in st.session_state:
         if st.button("⬅️ Volver al Panel Principal"): del st.session_state.active_id; st.rerun()
         st.title(f"📂 Auditoría: {st.session_state.active_name}")
-        col_menu = st.columns(3)
+        col_menu = st.columns(4)
         if col_menu[0].button("📊 Definir Materialidad", use_container_width=True): st.session_state.mod = "Mat"
         if col_menu[1].button("📝 Ejecutar Programa", use_container_width=True): st.session_state.mod = "Prog"
         if col_menu[2].button("📥 Importar Pasos", use_container_width=True): st.session_state.mod = "Imp"
+        if col_menu[3].button("📦 Exportar Expediente", use_container_width=True): st.session_state.mod = "Exp"
         
         mod = st.session_state.get('mod', 'Prog')
         if mod == "Prog": modulo_programa_trabajo(st.session_state.active_id)
         elif mod == "Imp": modulo_importacion(st.session_state.active_id)
+        elif mod == "Exp": modulo_exportacion(st.session_state.active_id)
         else: modulo_materialidad(st.session_state.active_id)
     else:
         st.title("💼 Mis Auditorías Asignadas")
@@ -364,18 +1857,42 @@ def vista_principal():
         c1, c2 = st.columns(2)
         c1.link_button("🌐 Consultar RUT (DIAN)", "https://muisca.dian.gov.co/WebRutMuisca/DefConsultaEstadoRUT.faces", use_container_width=True)
         c2.link_button("🏢 Consultar RUES", "https://www.rues.org.co/busqueda-avanzada", use_container_width=True)
+
+        texto = st.text_input("🔎 Buscar procedimientos en todos los clientes:", "", placeholder="Ej: arqueo caja, confirmación, independencia")
+        if texto:
+            resultados = buscar_procedimientos(texto)
+            if resultados.empty: st.caption("Sin coincidencias.")
+            for _, res in resultados.iterrows():
+                c_r, c_a = st.columns([5, 1])
+                c_r.markdown(f"**{res['client_name']}** · {res['area_name']} · [{res['step_code']}] {res['description'][:80]}  \n{res['fragmento']}")
+                if c_a.button("Abrir", key=f"bus_{res['id']}", use_container_width=True):
+                    st.session_state.active_id, st.session_state.active_name = int(res['client_id']), res['client_name']
+                    st.session_state.mod = "Prog"; st.rerun()
         st.divider()
         
-        conn = get_db_connection()
-        clients = pd.read_sql_query("SELECT * FROM clients WHERE is_deleted=0", conn)
+        cartera = st.expander("📈 Materialidad de la Cartera", key="exp_cartera", on_change="rerun")
+        with cartera:
+            if cartera.open: panel_cartera_materialidad()
+
+        clients = leer_clientes()
+        progreso = leer_progreso_clientes()
         for _, r in clients.iterrows():
             with st.container(border=True):
                 c1, c2, c3 = st.columns([4, 1.5, 0.5])
                 c1.write(f"**{r['client_name']}** | NIT: {r['client_nit']}")
+                av = progreso.get(int(r['id']), {'sin_iniciar': 0, 'en_proceso': 0, 'terminado': 0, 'evidencias': 0})
+                total = av['sin_iniciar'] + av['en_proceso'] + av['terminado']
+                c1.progress(av['terminado'] / total if total else 0.0,
+                            text=f"🟢 {av['terminado']}/{total} terminados · 🟡 {av['en_proceso']} en proceso · 📎 {av['evidencias']} evidencias")
+                det = c1.expander("Avance por área", key=f"avance_{r['id']}", on_change="rerun")
+                with det:
+                    if det.open:
+                        with conexion(int(r['id'])) as conn:
+                            st.dataframe(leer_progreso_areas(conn, int(r['id'])), hide_index=True, use_container_width=True)
                 
                 # Botón Descriptivo
                 if c2.button("📂 Gestionar Auditoría", key=f"op_{r['id']}", use_container_width=True):
-                    st.session_state.active_id, st.session_state.active_name = r['id'], r['client_name']; st.rerun()
+                    st.session_state.active_id, st.session_state.active_name = int(r['id']), r['client_name']; st.rerun()
                 
                 if is_admin:
                     # SEGURIDAD: Popover de confirmación para eliminar cliente
@@ -383,18 +1900,18 @@ def vista_principal():
                         st.markdown(f"⚠️ **¿Eliminar {r['client_name']}?**")
                         st.caption("Se ocultará de la lista.")
                         if st.button("Confirmar Eliminación", key=f"del_cli_{r['id']}", type="primary"):
-                            conn.execute("UPDATE clients SET is_deleted=1 WHERE id=?", (r['id'],)); conn.commit(); st.rerun()
-        conn.close()
+                            with transaccion() as conn:
+                                conn.execute("UPDATE clients SET is_deleted=1 WHERE id=?", (int(r['id']),))
+                            invalidar_cliente(CACHE_CLIENTES, int(r['id']))
+                            st.rerun()
 
+@instrumentar
 def vista_login():
     st.markdown('<div class="login-card"><h1 class="main-title">⚖️ AuditPro</h1>', unsafe_allow_html=True)
     e = st.text_input("Correo Corporativo")
     p = st.text_input("Contraseña", type="password")
     if st.button("🔐 Iniciar Sesión Segura", use_container_width=True):
-        conn = get_db_connection()
-        u = conn.execute("SELECT id, full_name, role FROM users WHERE email=? AND password_hash=?", 
-                         (e.strip().lower(), hashlib.sha256(p.strip().encode()).hexdigest())).fetchone()
-        conn.close()
+        u = autenticar(e, p)
         if u:
             st.session_state.user_id, st.session_state.user_name, st.session_state.user_role = u[0], u[1], u[2]
             st.rerun()
@@ -402,5 +1919,6 @@ def vista_login():
     st.markdown('</div>', unsafe_allow_html=True)
 
 if __name__ == "__main__":
-    if 'user_id' not in st.session_state: vista_login()
-    else: vista_principal()
+    with medir_rerun():
+        if 'user_id' not in st.session_state: vista_login()
+        else: vista_principal()
@@ -0,0 +1,189 @@
+"""Benchmark de las operaciones principales de AuditPro.
+
+Mide sobre una copia de la base generada con generar_datos.py (las escrituras
+del benchmark no alteran --dir, así dos corridas miden la misma carga) y
+escribe los resultados en JSON para comparar versiones:
+
+    python benchmarks/benchmark.py --dir bench_data --salida resultados.json
+    python benchmarks/benchmark.py --dir bench_data --comparar base.json
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(RAIZ, "app_auditoria.py")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--dir", default="bench_data", help="Directorio con audit_management.db")
+    p.add_argument("--cliente", type=int, help="Id del cliente medido (por defecto, el primer cliente sintético)")
+    p.add_argument("--repeticiones", type=int, default=20)
+    p.add_argument("--filas-csv", type=int, default=50_000)
+    p.add_argument("--salida", default="resultados_benchmark.json")
+    p.add_argument("--comparar", help="JSON de una corrida anterior para detectar regresiones")
+    p.add_argument("--tolerancia", type=float, default=0.2, help="Aumento relativo de p50 considerado regresión")
+    p.add_argument("--sin-apptest", action="store_true", help="Omite el render completo con AppTest")
+    return p.parse_args()
+
+
+def medir(fn, repeticiones, preparar=None):
+    tiempos = []
+    for i in range(repeticiones):
+        arg = preparar(i) if preparar else None
+        t = time.perf_counter()
+        fn(arg) if preparar else fn()
+        tiempos.append((time.perf_counter() - t) * 1000)
+    tiempos.sort()
+    return {'n': len(tiempos), 'min_ms': tiempos[0], 'p50_ms': statistics.median(tiempos),
+            'p95_ms': tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))], 'media_ms': statistics.fmean(tiempos)}
+
+
+class ArchivoSubido(io.BytesIO):
+    # Imita el UploadedFile de Streamlit (name, type, size)
+    def __init__(self, datos, name, type):
+        super().__init__(datos)
+        self.name, self.type, self.size = name, type, len(datos)
+
+
+def csv_procedimientos(filas, rnd):
+    lineas = ["Seccion,Area,Codigo,Descripcion,Instrucciones"]
+    lineas += [f"Activo,Area {i % 40},B{i},Procedimiento sintético {rnd.randint(0, 10**6)},NIA 500" for i in range(filas)]
+    return "\n".join(lineas).encode("utf-8-sig")
+
+
+def volumen(conn):
+    return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+            for t in ("users", "clients", "audit_steps", "audit_logs", "audit_evidence")}
+
+
+def copia_de_trabajo(origen):
+    """Copia la base (API de backup, incluye el WAL) y el archivo de logs a un directorio temporal.
+
+    El almacén de evidencias de la copia arranca vacío: el benchmark solo lee sus metadatos.
+    """
+    destino = tempfile.mkdtemp(prefix="copia_benchmark_", dir=origen)
+    fuente = sqlite3.connect(os.path.join(origen, "audit_management.db"))
+    copia = sqlite3.connect(os.path.join(destino, "audit_management.db"))
+    try: fuente.backup(copia)
+    finally: fuente.close(); copia.close()
+    if os.path.isdir(os.path.join(origen, "archivo_logs")):
+        shutil.copytree(os.path.join(origen, "archivo_logs"), os.path.join(destino, "archivo_logs"))
+    return destino
+
+
+def elegir_cliente(conn, cliente):
+    if cliente is None:
+        # Primer cliente creado por generar_datos.py: no cambia entre corridas ni al agregar clientes
+        fila = conn.execute("SELECT MIN(id) FROM clients WHERE is_deleted=0 AND client_name LIKE 'Cliente Sintético %'").fetchone()
+        cliente = fila[0]
+    if cliente is None or not conn.execute("SELECT 1 FROM clients WHERE id=? AND is_deleted=0", (cliente,)).fetchone():
+        sys.exit("No hay cliente para medir: genere datos con generar_datos.py o indique --cliente")
+    return cliente
+
+
+def correr(app, args):
+    rnd = random.Random(7)
+    rep = args.repeticiones
+    with app.conexion() as conn:
+        cliente = elegir_cliente(conn, args.cliente)
+        pasos = [r[0] for r in conn.execute("SELECT id FROM audit_steps WHERE client_id=? AND is_deleted=0", (cliente,))]
+        info = volumen(conn)
+    filtros = {'seccion': None, 'area': None, 'estado': None, 'texto': ''}
+    cache = app.obtener_cache()
+    r = {}
+
+    r['login'] = medir(lambda: app.autenticar("admin@auditpro.com", "admin123"), rep)
+    r['lista_clientes_fria'] = medir(lambda _: app.leer_clientes(), rep, preparar=lambda i: cache.invalidar(app.CACHE_CLIENTES))
+    r['lista_clientes_cache'] = medir(app.leer_clientes, rep)
+
+    def programa():
+        with app.conexion() as conn:
+            app.contar_pasos_por_area(conn, cliente, **filtros)
+            app.cargar_programa_trabajo(conn, cliente, **filtros)
+    r['programa_pagina_fria'] = medir(programa, rep)
+    r['programa_pagina_cache'] = medir(lambda: app.leer_pagina_programa(cliente, None, filtros), rep)
+
+    r['actualizar_paso'] = medir(lambda i: app.actualizar_paso_seguro(pasos[i % len(pasos)], 1, "Benchmark", f"Nota de benchmark {i} {time.time()}", "En Proceso"),
+                                 rep, preparar=lambda i: i)
+
+    r['evidencia_subida'] = medir(lambda f: app.guardar_evidencia(pasos[0], 1, f), rep,
+                                  preparar=lambda i: ArchivoSubido(rnd.randbytes(256 * 1024), f"bench_{i}.bin", "application/octet-stream"))
+    with app.conexion() as conn:
+        con_evidencia = [s for (s,) in conn.execute("SELECT DISTINCT step_id FROM audit_evidence LIMIT 40")]
+    def lista_evidencias():
+        with app.conexion() as conn:
+            app.listar_evidencias(conn, con_evidencia)
+    r['evidencia_lista'] = medir(lista_evidencias, rep)
+
+    datos_csv = csv_procedimientos(args.filas_csv, rnd)
+    def nuevo_cliente(i):
+        with app.transaccion() as conn:
+            return conn.execute("INSERT INTO clients (user_id, client_name, client_nit) VALUES (1, ?, '0')", (f"Benchmark CSV {i}",)).lastrowid
+    r['importacion_csv'] = medir(lambda cid: app.importar_procedimientos(cid, ArchivoSubido(datos_csv, "bench.csv", "text/csv"), "bench.csv"),
+                                 max(1, rep // 10), preparar=nuevo_cliente)
+    r['importacion_csv']['filas'] = args.filas_csv
+
+    if not args.sin_apptest:
+        from streamlit.testing.v1 import AppTest
+        def render():
+            at = AppTest.from_file(APP, default_timeout=120)
+            at.session_state.user_id, at.session_state.user_name, at.session_state.user_role = 1, "Benchmark", "Administrador"
+            at.session_state.active_id, at.session_state.active_name, at.session_state.mod = cliente, "Benchmark", "Prog"
+            at.run()
+            if at.exception: raise RuntimeError(at.exception)
+        r['render_programa_apptest'] = medir(render, max(1, rep // 4))
+
+    return {'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+            'version_app': hashlib.sha256(open(APP, 'rb').read()).hexdigest()[:12],
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'cliente_medido': cliente, 'volumen': info, 'resultados': r}
+
+
+def comparar(actual, base, tolerancia):
+    regresiones = []
+    for op, res in actual['resultados'].items():
+        previo = base['resultados'].get(op)
+        if not previo: continue
+        cambio = res['p50_ms'] / previo['p50_ms'] - 1 if previo['p50_ms'] else 0.0
+        marca = "REGRESIÓN" if cambio > tolerancia else ""
+        print(f"{op:28s} {previo['p50_ms']:10.2f} -> {res['p50_ms']:10.2f} ms  ({cambio:+.0%}) {marca}")
+        if marca: regresiones.append(op)
+    return regresiones
+
+
+def main():
+    args = parse_args()
+    salida = os.path.abspath(args.salida)
+    base = json.load(open(args.comparar)) if args.comparar else None
+    trabajo = copia_de_trabajo(os.path.abspath(args.dir))
+    try:
+        os.chdir(trabajo)
+        sys.path.insert(0, RAIZ)
+        import app_auditoria as app
+        resultado = correr(app, args)
+        app.obtener_pool().cerrar()
+    finally:
+        os.chdir(RAIZ)
+        shutil.rmtree(trabajo, ignore_errors=True)
+    with open(salida, "w") as f: json.dump(resultado, f, indent=2)
+    for op, res in resultado['resultados'].items():
+        print(f"{op:28s} p50 {res['p50_ms']:10.2f} ms   p95 {res['p95_ms']:10.2f} ms")
+    print(f"Resultados en {salida}")
+    if base and comparar(resultado, base, args.tolerancia): sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Generador de encargos sintéticos para medir cómo escala AuditPro.
+
+Crea (o amplía) audit_management.db y el almacén de evidencias dentro de --dir
+con los volúmenes indicados. Ejemplo con los volúmenes de referencia:
+
+    python benchmarks/generar_datos.py --dir bench_data --clientes 1000 \\
+        --pasos 500 --logs 5000000 --evidencias 20000
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AREAS = ["Caja", "Bancos", "Cuentas por Cobrar", "Inventarios", "Propiedad Planta y Equipo",
+         "Proveedores", "Obligaciones Financieras", "Impuestos", "Patrimonio", "Ingresos", "Gastos"]
+SECCIONES = ["Planeación", "Activo", "Pasivo", "Patrimonio", "Resultados", "Cierre"]
+VERBOS = ["Verificar", "Confirmar", "Recalcular", "Inspeccionar", "Conciliar", "Observar", "Evaluar", "Documentar"]
+OBJETOS = ["saldos con terceros", "arqueo de caja", "cortes de documentos", "valuación al cierre",
+           "independencia del equipo", "conciliaciones bancarias", "depreciación acumulada", "provisiones"]
+ESTADOS = ["Sin Iniciar", "En Proceso", "Terminado"]
+# Mezcla de tamaños de evidencia: (bytes, peso relativo)
+TAMANOS_EVIDENCIA = [(20 * 1024, 60), (250 * 1024, 30), (2 * 1024 * 1024, 9), (10 * 1024 * 1024, 1)]
+LOTE = 50_000
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--dir", default="bench_data", help="Directorio de trabajo (se crea si no existe)")
+    p.add_argument("--clientes", type=int, default=1000)
+    p.add_argument("--pasos", type=int, default=500, help="Pasos por cliente")
+    p.add_argument("--logs", type=int, default=5_000_000, help="Filas totales de audit_logs")
+    p.add_argument("--evidencias", type=int, default=20_000, help="Evidencias totales")
+    p.add_argument("--duplicadas", type=float, default=0.1, help="Fracción de evidencias con contenido repetido")
+    p.add_argument("--semilla", type=int, default=42)
+    return p.parse_args()
+
+
+def lotes(generador, tam=LOTE):
+    bloque = []
+    for fila in generador:
+        bloque.append(fila)
+        if len(bloque) == tam:
+            yield bloque; bloque = []
+    if bloque: yield bloque
+
+
+def generar(app, args, rnd):
+    t0 = time.perf_counter()
+    with app.transaccion() as conn:
+        primer_cliente = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM clients").fetchone()[0]) + 1
+        conn.executemany("INSERT INTO users (email, full_name, password_hash, role) VALUES (?,?,?,?)",
+                         [(f"auditor{i}@bench.local", f"Auditor {i}", "x", "Miembro") for i in range(primer_cliente, primer_cliente + 50)])
+        conn.executemany("INSERT INTO clients (user_id, client_name, client_nit) VALUES (?,?,?)",
+                         [(1, f"Cliente Sintético {i}", f"900{i:06d}") for i in range(primer_cliente, primer_cliente + args.clientes)])
+    clientes = range(primer_cliente, primer_cliente + args.clientes)
+    print(f"clientes: {args.clientes} ({time.perf_counter() - t0:.1f}s)")
+
+    def pasos():
+        for cid in clientes:
+            for n in range(args.pasos):
+                area = AREAS[n % len(AREAS)]
+                yield (cid, SECCIONES[n % len(SECCIONES)], area, f"{1000 + n * 10}",
+                       f"{rnd.choice(VERBOS)} {rnd.choice(OBJETOS)} en {area.lower()}",
+                       f"NIA {rnd.choice([230, 315, 330, 500, 505, 520, 530])}: aplicar el procedimiento y documentar.",
+                       rnd.choice(["", "", "Sin excepciones.", "Se solicitó soporte adicional al cliente."]),
+                       rnd.choice(ESTADOS))
+    for bloque in lotes(pasos()):
+        with app.transaccion() as conn:
+            conn.executemany("""INSERT INTO audit_steps (client_id, section_name, area_name, step_code, description, instructions, user_notes, status)
+                VALUES (?,?,?,?,?,?,?,?)""", bloque)
+    with app.conexion() as conn:
+        rango = conn.execute("SELECT MIN(id), MAX(id) FROM audit_steps WHERE client_id >= ?", (primer_cliente,)).fetchone()
+    print(f"pasos: {args.clientes * args.pasos} ({time.perf_counter() - t0:.1f}s)")
+
+    def logs():
+        for _ in range(args.logs):
+            estado = rnd.choice(ESTADOS)
+            yield (rnd.randint(*rango), 1, "Auditor Sintético", f"Estado: Sin Iniciar -> {estado}", "", "Notas de avance",
+                   f"20{rnd.randint(20, 25)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} {rnd.randint(7, 19):02d}:{rnd.randint(0, 59):02d}:00")
+    for i, bloque in enumerate(lotes(logs())):
+        with app.transaccion() as conn:
+            conn.executemany("INSERT INTO audit_logs (step_id, user_id, user_name, action, previous_value, new_value, timestamp) VALUES (?,?,?,?,?,?,?)", bloque)
+        if i % 20 == 0: print(f"  logs: {min((i + 1) * LOTE, args.logs):,}")
+    print(f"logs: {args.logs} ({time.perf_counter() - t0:.1f}s)")
+
+    tamanos, pesos = zip(*TAMANOS_EVIDENCIA)
+    repetibles = []
+    filas = []
+    for n in range(args.evidencias):
+        if repetibles and rnd.random() < args.duplicadas:
+            file_hash, tam = rnd.choice(repetibles)
+        else:
+            file_hash, tam = app.almacenar_archivo(io.BytesIO(rnd.randbytes(rnd.choices(tamanos, pesos)[0])))
+            if len(repetibles) < 100: repetibles.append((file_hash, tam))
+        filas.append((rnd.randint(*rango), 1, f"soporte_{n}.pdf", "application/pdf", file_hash, tam))
+    for bloque in lotes(iter(filas)):
+        with app.transaccion() as conn:
+            conn.executemany("INSERT INTO audit_evidence (step_id, user_id, file_name, file_type, file_hash, file_size) VALUES (?,?,?,?,?,?)", bloque)
+    print(f"evidencias: {args.evidencias} ({time.perf_counter() - t0:.1f}s)")
+
+    with app.conexion() as conn:
+        conn.execute("ANALYZE")
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+    os.chdir(args.dir)
+    sys.path.insert(0, RAIZ)
+    import app_auditoria as app  # crea el esquema con las migraciones al importarse
+    generar(app, args, random.Random(args.semilla))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Divide audit_management.db en un catálogo y un archivo SQLite por cliente.
+
+Se ejecuta una sola vez, con la app detenida, dentro del directorio de datos:
+
+    python herramientas/dividir_en_shards.py --dir .
+
+La base original queda intacta como respaldo. Para repetir la división hay que
+borrar audit_catalog.db y el directorio shards/. Después se arranca la app con
+AUDITPRO_SHARDS=1.
+"""
+import argparse
+import os
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--dir", default=".", help="Directorio con audit_management.db y el almacén de evidencias")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.chdir(args.dir)
+    # La app se importa en modo monolítico: así migra la base de origen y no crea un catálogo vacío
+    os.environ["AUDITPRO_SHARDS"] = "0"
+    sys.path.insert(0, RAIZ)
+    import app_auditoria as app
+    t0 = time.perf_counter()
+    resumen = app.dividir_en_shards(al_progresar=lambda avance, mensaje: print(f"  {avance:6.1%}  {mensaje}"))
+    print(f"Clientes: {resumen['clientes']:,}  pasos: {resumen['pasos']:,}  evidencias: {resumen['evidencias']:,}  "
+          f"logs: {resumen['logs']:,} (+{resumen['logs_archivados']:,} desarchivados)  en {time.perf_counter() - t0:.1f}s")
+    print(f"Catálogo: {app.CATALOGO_PATH}  shards: {app.SHARDS_DIR}/  -> inicie la app con AUDITPRO_SHARDS=1")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import importlib
+import os
+import sys
+
+import pytest
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def cargar_app(tmp_path, monkeypatch):
+    """Importa app_auditoria dentro de un directorio temporal (la importación crea y migra la base)."""
+    def cargar(shards=False):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv("AUDITPRO_SHARDS", "1" if shards else "0")
+        # El pool y el estado de shards viven en st.cache_resource y sobreviven a la reimportación
+        st.cache_resource.clear(); st.cache_data.clear()
+        sys.modules.pop("app_auditoria", None)
+        return importlib.import_module("app_auditoria")
+    yield cargar
+    if "app_auditoria" in sys.modules: sys.modules["app_auditoria"].obtener_pool().cerrar()
+    st.cache_resource.clear(); st.cache_data.clear()
@@ -0,0 +1,11 @@
+def test_consultas_criticas_usan_indice(cargar_app, tmp_path):
+    app = cargar_app()
+    conn = app.get_db_connection(str(tmp_path / "migrada.db"))
+    try:
+        app.migrar_base(conn, app.AMBITO_COMPLETO)
+        planes = app.verificar_planes_consulta(conn)
+    finally:
+        conn.close()
+    assert set(planes) == set(app.CONSULTAS_INDEXADAS)
+    sin_indice = {nombre: detalle for nombre, (usa_indice, detalle) in planes.items() if not usa_indice}
+    assert not sin_indice, sin_indice
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def _cartera(app, filas):
+    with app.transaccion() as conn:
+        for i, (benchmark, valor, p_gen, p_perf, p_ranr) in enumerate(filas):
+            cid = conn.execute("INSERT INTO clients (user_id, client_name, client_nit) VALUES (1,?,'1')", (f"Cliente {i:03d}",)).lastrowid
+            m_gen = valor * p_gen / 100
+            conn.execute("INSERT INTO materiality VALUES (?,?,?,?,?,?,?,?,?)",
+                         (cid, benchmark, valor, p_gen, m_gen, p_perf, m_gen * p_perf / 100, p_ranr, m_gen * p_ranr / 100))
+    return app.cargar_cartera_materialidad()
+
+
+def test_valores_sugeridos_de_los_sliders_no_generan_alertas(cargar_app):
+    app = cargar_app()
+    filas = [(b, 1e6, sugerido, app.RANGO_PERFORMANCE[2], app.RANGO_RANR[2]) for b, (_, _, sugerido) in app.RANGOS_BENCHMARK.items()]
+    assert app.validar_umbrales(_cartera(app, filas)) == [[] for _ in filas]
+
+
+def test_porcentajes_fuera_de_los_sliders_generan_alertas(cargar_app):
+    app = cargar_app()
+    _, max_p, _ = app.RANGOS_BENCHMARK["EBITDA"]
+    motivos = app.validar_umbrales(_cartera(app, [("EBITDA", 1e6, max_p + 1, 50.0, 5.0), ("EBITDA", 1e6, 0.0, 50.0, 5.0), ("Otro", 1e6, 1.0, 50.0, 5.0)]))
+    assert all("% general fuera del rango del benchmark" in m for m in motivos)
+
+
+def test_resumen_sensibilidad_coincide_con_la_rejilla_completa(cargar_app):
+    app = cargar_app()
+    rnd = np.random.default_rng(7)
+    benchmarks = list(app.RANGOS_BENCHMARK) + ["Otro"]
+    cartera = _cartera(app, [(benchmarks[i % len(benchmarks)], rnd.uniform(-1e6, 1e9), 2.0, 50.0, 5.0) for i in range(25)])
+    pasos = (5, 4, 3)
+    resumen = app.resumen_sensibilidad(cartera, *pasos)
+    pp, pr = (app.rejilla_porcentajes(*rango[:2], n) for rango, n in ((app.RANGO_PERFORMANCE, pasos[1]), (app.RANGO_RANR, pasos[2])))
+    for i, (benchmark, valor) in enumerate(zip(cartera['benchmark'], cartera['benchmark_value'])):
+        fila = resumen.iloc[i]
+        if benchmark not in app.RANGOS_BENCHMARK:
+            assert np.isnan(fila.iloc[3:].to_numpy(dtype=float)).all(); continue
+        g, p, r = np.meshgrid(app.rejilla_porcentajes(*app.RANGOS_BENCHMARK[benchmark][:2], pasos[0]), pp, pr, indexing='ij')
+        general = (valor * g / 100).ravel()
+        for etiqueta, escenarios in (("Mat. General", general), ("Performance", general * p.ravel() / 100), ("RANR", general * r.ravel() / 100)):
+            esperado = (escenarios.min(), np.median(escenarios), escenarios.max())
+            assert np.allclose([fila[f"{etiqueta} {s}"] for s in ("mín", "mediana", "máx")], esperado), (benchmark, etiqueta)
+
+
+def test_resumen_sensibilidad_sin_benchmarks_conocidos(cargar_app):
+    app = cargar_app()
+    resumen = app.resumen_sensibilidad(_cartera(app, [("Otro", 1e6, 1.0, 50.0, 5.0)]))
+    assert np.isnan(resumen.iloc[0, 3:].to_numpy(dtype=float)).all()
@@ -0,0 +1,12 @@
+def test_recorrer_mas_shards_que_el_limite_del_pool(cargar_app):
+    app = cargar_app(shards=True)
+    total = app.MAX_BASES_POR_HILO + 8
+    for i in range(total):
+        with app.transaccion() as conn:
+            cid = conn.execute("INSERT INTO clients (user_id, client_name, client_nit) VALUES (1,?,'1')", (f"Cliente {i:02d}",)).lastrowid
+        with app.transaccion(cid) as conn: app.cargar_pasos_iniciales(conn, cid)
+    # Proceso recién iniciado: ningún shard migrado ni conexión abierta
+    app.obtener_estado_shards()['listos'].clear(); app.obtener_pool().cerrar()
+    progreso = app.leer_progreso_clientes()
+    assert len(progreso) == total
+    assert all(p['sin_iniciar'] > 0 for p in progreso.values())